@@ -2,17 +2,24 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 from trytond.pool import Pool
+from . import configuration
 from . import template
 from . import electronic_mail
 from . import trigger
 from . import report
+from . import smtp
+from . import user
 
 
 def register():
     Pool.register(
+        configuration.Configuration,
+        configuration.ConfigurationCompany,
         electronic_mail.ElectronicMail,
         report.ActionReport,
+        smtp.SmtpServer,
         template.Template,
         template.TemplateReport,
         trigger.Trigger,
+        user.User,
         module='electronic_mail_template', type_='model')
@@ -0,0 +1,32 @@
+# This file is part electronic_mail_template module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+
+class ConfigurationCacheMixin(object):
+    'Clear the cached mail configuration when it is modified'
+
+    @classmethod
+    def create(cls, vlist):
+        records = super().create(vlist)
+        Pool().get('electronic.mail')._configuration_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        Pool().get('electronic.mail')._configuration_cache.clear()
+
+    @classmethod
+    def delete(cls, records):
+        super().delete(records)
+        Pool().get('electronic.mail')._configuration_cache.clear()
+
+
+class Configuration(ConfigurationCacheMixin, metaclass=PoolMeta):
+    __name__ = 'electronic.mail.configuration'
+
+
+class ConfigurationCompany(ConfigurationCacheMixin, metaclass=PoolMeta):
+    __name__ = 'electronic.mail.configuration.company'
@@ -1,29 +1,62 @@
 # This file is part electronic_mail_template module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import datetime
 import logging
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from email.header import decode_header, make_header
+from email.utils import getaddresses, parsedate
 import trytond.config as config
-from trytond.model import ModelView, fields
+from trytond.cache import Cache
+from sql import Null
+from trytond.model import Index, ModelView, fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, Bool
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
+from trytond.tools import escape_wildcard, grouped_slice
 from trytond.transaction import Transaction
 from trytond.modules.electronic_mail_template.tools import (
     recipients_from_fields)
+from trytond.modules.electronic_mail_template.smtp import (
+    SMTPConnection, deliver)
 
+RECIPIENT_RATE_LIMIT = config.getint('electronic_mail', 'recipient_rate_limit',
+    default=0)
+RECIPIENT_RATE_PERIOD = datetime.timedelta(hours=1)
+SERVER_RATE_PERIOD = datetime.timedelta(minutes=1)
+SMTP_RETRY_DELAY = datetime.timedelta(seconds=config.getint('electronic_mail',
+    'smtp_retry_delay', default=300))
 PRODUCTION_ENV = config.getboolean('database', 'production', default=False)
 QUEUE_NAME = config.get('electronic_mail', 'queue_name', default='default')
+SEND_BATCH_SIZE = config.getint('electronic_mail', 'send_batch_size',
+    default=100)
 logger = logging.getLogger(__name__)
 
 
 class ElectronicMail(metaclass=PoolMeta):
     __name__ = 'electronic.mail'
     template = fields.Many2One('electronic.mail.template', 'Template')
+    render_key = fields.Char('Render Key', readonly=True,
+        help='Identifies the template, record and language the mail was '
+        'rendered from.')
+    _default_smtp_server_cache = Cache(
+        'electronic.mail.default_smtp_server', context=False)
+    _configuration_cache = Cache('electronic.mail.send_configuration')
+    # Bounded by the "electronic.mail.validate_email" key of the [cache]
+    # section
+    _validate_email_cache = Cache('electronic.mail.validate_email',
+        context=False)
 
     @classmethod
     def __setup__(cls):
         super(ElectronicMail, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.render_key, Index.Equality()),
+                where=t.render_key != Null))
         cls._buttons.update({
                 'send_mail': {
                     'invisible': (
@@ -38,41 +71,159 @@ class ElectronicMail(metaclass=PoolMeta):
         '''It should be possible to overwrite templates'''
         return True
 
+    @classmethod
+    def get_default_smtp_server(cls):
+        'Returns the default SMTP server or None'
+        SMTP = Pool().get('smtp.server')
+        server_id = cls._default_smtp_server_cache.get('default', -1)
+        if server_id == -1:
+            smtp_servers = SMTP.search([
+                    ('state', '=', 'done'),
+                    ('default', '=', True),
+                    ], limit=1)
+            server_id = smtp_servers[0].id if smtp_servers else None
+            cls._default_smtp_server_cache.set('default', server_id)
+        return SMTP(server_id) if server_id is not None else None
+
+    @classmethod
+    def get_configuration_values(cls):
+        '''Returns a dictionary with the mail configuration used to send
+
+        The draft mailbox is returned as its id.
+        '''
+        Configuration = Pool().get('electronic.mail.configuration')
+        values = cls._configuration_cache.get('configuration')
+        if values is None:
+            config = Configuration(1)
+            values = {
+                'draft': config.draft.id if config.draft else None,
+                'send_email_after': config.send_email_after,
+                }
+            cls._configuration_cache.set('configuration', values)
+        return values
+
+    @staticmethod
+    def _get_values_from_message(message, mailbox, record=None,
+            mail_file=None):
+        '''Returns the values to create an electronic mail from a message
+
+        The headers are mapped like create_from_mail does so both create the
+        same mails.
+
+        :param message: 'email.message.Message' instance
+        :param mailbox: Browse record or ID of the mailbox
+        :param record: Browse record the mail is related to
+        :param mail_file: File with the serialized message to use instead of
+            serializing the message
+        '''
+        def header(name):
+            value = message.get(name)
+            if value is None:
+                return None
+            return str(make_header(decode_header(value)))
+
+        date = message.get('date')
+        if date:
+            date = datetime.datetime.fromtimestamp(
+                time.mktime(parsedate(date)))
+        return {
+            'mailbox': getattr(mailbox, 'id', mailbox),
+            'from_': header('from'),
+            'sender': header('sender'),
+            'to': header('to'),
+            'cc': header('cc'),
+            'bcc': header('bcc'),
+            'subject': header('subject'),
+            'date': date,
+            'message_id': message.get('message-id'),
+            'in_reply_to': message.get('in-reply-to'),
+            'mail_file': (mail_file.read() if mail_file
+                else message.as_bytes()),
+            'resource': str(record) if record else None,
+            }
+
+    @classmethod
+    def create_from_mails(cls, messages, template=None, values=None):
+        '''Creates the electronic mails of the messages in a single create
+
+        :param messages: List of tuples with the message, the mailbox, the
+            record the mail is related to and optionally the file with the
+            serialized message
+        :param template: Browse record of the template that rendered them
+        :param values: List of dictionaries with extra values for each mail
+        :return: List of electronic mails
+        '''
+        to_create = []
+        for i, message in enumerate(messages):
+            mail_values = cls._get_values_from_message(*message)
+            if template:
+                mail_values['template'] = template.id
+            if values:
+                mail_values.update(values[i])
+            to_create.append(mail_values)
+        if not to_create:
+            return []
+        return cls.create(to_create)
+
+    @classmethod
+    def _validate_email(cls, value):
+        '''Returns validate_emails of the value without raising
+
+        The result is cached by value as the same addresses are validated
+        again and again.
+        '''
+        result = cls._validate_email_cache.get(value)
+        if result is None:
+            result = (cls.validate_emails(value, raise_exception=False),)
+            cls._validate_email_cache.set(value, result)
+        return result[0]
+
+    @classmethod
+    def get_senders_and_recipients(cls, mails):
+        '''Parses and validates the addresses of the mails in one pass
+
+        :return: Dictionary with the mail id as key and a tuple with the
+            validated sender, the recipients and whether all the recipients
+            are valid
+        '''
+        result = {}
+        for mail in mails:
+            sender = cls._validate_email((mail.from_ or '').strip())
+            recipients = [r.strip() for r in recipients_from_fields(mail)
+                if r and r.strip()]
+            valid = bool(recipients) and all(
+                cls._validate_email(r) for r in recipients)
+            result[mail.id] = (sender, recipients, valid)
+        return result
+
     @classmethod
     def _get_sender_and_recipients(cls, mail):
-        sender = cls.validate_emails(
-            (mail.from_ or '').strip(), raise_exception=False)
-        recipients = [r.strip() for r in recipients_from_fields(mail)
-            if r and r.strip()]
+        sender, recipients, _ = cls.get_senders_and_recipients(
+            [mail])[mail.id]
         return sender, recipients
 
     @classmethod
     @ModelView.button
     def send_mail(cls, mails):
-        pool = Pool()
-        Configuration = pool.get('electronic.mail.configuration')
-        SMTP = pool.get('smtp.server')
-
         if not PRODUCTION_ENV:
             return
 
-        config = Configuration(1)
-
-        smtp_servers = SMTP.search([
-                ('state', '=', 'done'),
-                ('default', '=', True),
-                ], limit=1)
-        if not smtp_servers:
+        send_email_after = cls.get_configuration_values()['send_email_after']
+        if not cls.get_default_smtp_server():
             raise UserError(gettext(
                 'electronic_mail_template.msg_smtp_server_default'))
 
+        # Given that the lock (which is a SELECT FOR UPDATE NOWAIT) guarantees
+        # that no concurrent process is updating them, we must read now the
+        # flag_send value, and not rely on the value that may be in the cache
+        # of the objects before the lock, which could have an older value.
+        # Browsing them again reads the values of all of them at once.
+        cls.lock(mails)
+        mails = cls.browse([m.id for m in mails])
+
         to_send = []
+        addresses = cls.get_senders_and_recipients(mails)
         for mail in mails:
-            cls.lock([mail])
-            # Given that the lock (which is a SELECT FOR UPDATE NOWAIT) guarantees that no concurrent
-            # process is updating it, we must read now the flag_send value, and not rely on the value that
-            # may be in the cache of the object before the lock, which could have an older value.
-            mail = cls(mail.id)
             if mail.flag_send:
                 continue
             if not mail.mail_file:
@@ -80,44 +231,58 @@ class ElectronicMail(metaclass=PoolMeta):
                         'electronic_mail_template.msg_smtp_server_default',
                         email=mail.rec_name))
 
-            sender, recipients = cls._get_sender_and_recipients(mail)
+            sender, recipients, valid = addresses[mail.id]
             # validate_emails raise UserError or return ''
-            if sender and cls.validate_emails(recipients):
+            if sender and (valid or cls.validate_emails(recipients)):
                 to_send.append(mail)
 
-        for mail in to_send:
-            with Transaction().set_context(
-                    queue_name=QUEUE_NAME,
-                    queue_scheduled_at=config.send_email_after):
-                cls.__queue__._send_mail([mail])
+        with Transaction().set_context(
+                queue_name=QUEUE_NAME,
+                queue_scheduled_at=send_email_after):
+            for sub_mails in grouped_slice(to_send, SEND_BATCH_SIZE):
+                cls.__queue__._send_mail(list(sub_mails))
 
     @classmethod
     def _send_mail(cls, mails):
         pool = Pool()
-        Configuration = pool.get('electronic.mail.configuration')
         SMTP = pool.get('smtp.server')
+        Template = pool.get('electronic.mail.template')
+
+        draft_mailbox = cls.get_configuration_values()['draft']
+        smtp_server = cls.get_default_smtp_server()
 
-        config = Configuration(1)
-        draft_mailbox = config.draft
+        # The same mail may be enqueued again, for example when a rendered
+        # mail is reused, so the mails already sent by another task are
+        # skipped once locked
+        cls.lock(mails)
+        mails = [m for m in cls.browse([m.id for m in mails])
+            if not m.flag_send]
 
-        smtp_servers = SMTP.search([
-                ('state', '=', 'done'),
-                ('default', '=', True),
-                ], limit=1)
-        smtp_server = smtp_servers[0] if smtp_servers else None
+        # Read the servers and mailboxes of all the templates at once
+        templates = {t['id']: t for t in Template.read(
+                list({m.template.id for m in mails if m.template}),
+                ['smtp_server', 'draft_mailbox'])}
+        smtp_servers = {s.id: s for s in SMTP.browse(
+                list({t['smtp_server'] for t in templates.values()
+                        if t['smtp_server']}))}
 
         to_flag_send = []
         to_draft = []
+        to_deliver = defaultdict(list)
+        addresses = cls.get_senders_and_recipients(mails)
         for mail in mails:
             if not mail.mail_file:
                 continue
 
-            sender, recipients = cls._get_sender_and_recipients(mail)
+            sender, recipients, valid = addresses[mail.id]
 
-            mail_smtp_server = (mail.template.smtp_server if mail.template
-                else smtp_server)
-            mail_draft_mailbox = (mail.template.draft_mailbox if mail.template
-                else draft_mailbox)
+            if mail.template:
+                template = templates[mail.template.id]
+                mail_smtp_server = smtp_servers.get(template['smtp_server'])
+                mail_draft_mailbox = template['draft_mailbox']
+            else:
+                mail_smtp_server = smtp_server
+                mail_draft_mailbox = draft_mailbox
 
             if not mail_smtp_server or not mail_draft_mailbox:
                 if not mail_smtp_server:
@@ -129,18 +294,175 @@ class ElectronicMail(metaclass=PoolMeta):
                 continue
 
             # Validate recipients to send or move email to draft mailbox
-            if (not sender
-                    or not cls.validate_emails(
-                        recipients, raise_exception=False)):
+            if not sender or not valid:
                 to_draft.extend(([mail], {'mailbox': mail_draft_mailbox}))
                 continue
 
-            mail_smtp_server.send_mail(sender, recipients, mail.mail_file)
-            if not mail.flag_send:
-                to_flag_send.append(mail)
+            to_deliver[mail_smtp_server].append((mail, sender, recipients))
+
+        to_delay = defaultdict(list)
+        for mail_smtp_server, deliveries in to_deliver.items():
+            deliveries = cls._apply_rate_limits(mail_smtp_server, deliveries,
+                smtp_server, to_delay)
+            if not deliveries:
+                continue
+            workers = min(
+                mail_smtp_server.delivery_workers or 1, len(deliveries))
+            if workers > 1:
+                sent, refused = cls._deliver_parallel(
+                    mail_smtp_server, deliveries, workers)
+            else:
+                sent, refused = cls._deliver(mail_smtp_server, deliveries)
+            to_flag_send.extend(sent)
+            # Temporary failures are sent again later
+            to_delay[SMTP_RETRY_DELAY].extend(refused)
 
         if to_flag_send:
             cls.write(to_flag_send, {'flag_send': True})
 
         if to_draft:
             cls.write(*to_draft)
+
+        for delay, delayed_mails in to_delay.items():
+            if not delayed_mails:
+                continue
+            with Transaction().set_context(
+                    queue_name=QUEUE_NAME,
+                    queue_scheduled_at=delay):
+                cls.__queue__._send_mail(delayed_mails)
+
+    @classmethod
+    def _apply_rate_limits(cls, smtp_server, deliveries, default_smtp_server,
+            to_delay):
+        '''Returns the deliveries allowed by the rate limits
+
+        The mails over the rate limit of the SMTP server or of one of their
+        recipients are added to to_delay under the delay to send them again.
+        '''
+        now = datetime.datetime.now()
+        if smtp_server.rate_limit:
+            domain = [
+                ('flag_send', '=', True),
+                ('write_date', '>=', now - SERVER_RATE_PERIOD),
+                ]
+            if smtp_server == default_smtp_server:
+                domain.append(['OR',
+                        ('template.smtp_server', '=', smtp_server.id),
+                        ('template', '=', None),
+                        ])
+            else:
+                domain.append(('template.smtp_server', '=', smtp_server.id))
+            available = max(smtp_server.rate_limit - cls.search_count(domain),
+                0)
+            to_delay[SERVER_RATE_PERIOD].extend(
+                mail for mail, _, _ in deliveries[available:])
+            deliveries = deliveries[:available]
+
+        if RECIPIENT_RATE_LIMIT:
+            counts = cls._get_recipient_counts(
+                {r.lower() for _, _, recipients in deliveries
+                    for r in recipients},
+                now - RECIPIENT_RATE_PERIOD)
+            allowed = []
+            for delivery in deliveries:
+                recipients = {r.lower() for r in delivery[2]}
+                if any(counts[r] >= RECIPIENT_RATE_LIMIT for r in recipients):
+                    to_delay[RECIPIENT_RATE_PERIOD].append(delivery[0])
+                    continue
+                for recipient in recipients:
+                    counts[recipient] += 1
+                allowed.append(delivery)
+            deliveries = allowed
+        return deliveries
+
+    @classmethod
+    def _get_recipient_counts(cls, recipients, since):
+        '''Returns the number of mails sent to each recipient since the date
+
+        The mails that may include the recipients are searched with a single
+        query per slice of recipients. Their addresses are then parsed so
+        only the exact addresses are counted.
+
+        :param recipients: Set of lower case addresses
+        :return: Dictionary with the address as key and the count as value
+        '''
+        counts = dict.fromkeys(recipients, 0)
+        for sub_recipients in grouped_slice(list(counts), 100):
+            sub_recipients = list(sub_recipients)
+            domain = ['OR']
+            for recipient in sub_recipients:
+                pattern = '%' + escape_wildcard(recipient) + '%'
+                domain.extend([
+                        ('to', 'ilike', pattern),
+                        ('cc', 'ilike', pattern),
+                        ('bcc', 'ilike', pattern),
+                        ])
+            mails = cls.search_read([
+                    ('flag_send', '=', True),
+                    ('write_date', '>=', since),
+                    domain,
+                    ], fields_names=['to', 'cc', 'bcc'])
+            for mail in mails:
+                addresses = {a.lower() for _, a in getaddresses(
+                        [mail[f] for f in ('to', 'cc', 'bcc') if mail[f]])}
+                for recipient in sub_recipients:
+                    if recipient in addresses:
+                        counts[recipient] += 1
+        return counts
+
+    @classmethod
+    def _deliver(cls, smtp_server, deliveries):
+        '''Sends the mails over the same connection
+
+        A mail that fails is logged and left unsent so the mails sent before
+        it are still flagged.
+
+        :param deliveries: List of tuples with the mail, the sender and the
+            recipients
+        :return: Tuple with the list of the sent mails and the list of the
+            mails temporarily refused by the server
+        '''
+        sent, refused = [], []
+        with SMTPConnection(smtp_server) as connection:
+            for mail, sender, recipients in deliveries:
+                try:
+                    if connection.send(sender, recipients, mail.mail_file):
+                        sent.append(mail)
+                    else:
+                        refused.append(mail)
+                except Exception:
+                    logger.error('Could not send mail ID: %s', mail.id,
+                        exc_info=True)
+                    connection.close()
+        return sent, refused
+
+    @classmethod
+    def _deliver_parallel(cls, smtp_server, deliveries, workers):
+        '''Sends the mails spread over workers threads
+
+        Each thread holds its own connection to the SMTP server.
+        :return: Tuple with the list of the sent mails and the list of the
+            mails temporarily refused by the server
+        '''
+        transaction = Transaction()
+        payloads = [(mail.id, sender, recipients, mail.mail_file)
+            for mail, sender, recipients in deliveries]
+        chunks = [payloads[i::workers] for i in range(workers)]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(deliver,
+                    transaction.database.name, transaction.user,
+                    dict(transaction.context), smtp_server.id, chunk)
+                for chunk in chunks]
+        results = {}
+        for future, chunk in zip(futures, chunks):
+            try:
+                results.update(future.result())
+            except Exception:
+                # The mails of the failed worker are neither flagged as sent
+                # nor sent again
+                logger.error('Could not send mails with SMTP server "%s"',
+                    smtp_server.rec_name, exc_info=True)
+                results.update((mail_id, None) for mail_id, _, _, _ in chunk)
+        return ([mail for mail, _, _ in deliveries if results[mail.id]],
+            [mail for mail, _, _ in deliveries
+                if results[mail.id] is False])
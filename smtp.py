@@ -0,0 +1,160 @@
+# This file is part electronic_mail_template module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import logging
+import smtplib
+import trytond.config as config
+from trytond.model import fields
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+MAX_MESSAGES_PER_CONNECTION = config.getint('electronic_mail',
+    'smtp_max_messages_per_connection', default=100)
+DELIVERY_WORKERS = config.getint('electronic_mail', 'smtp_delivery_workers',
+    default=1)
+logger = logging.getLogger(__name__)
+
+
+class SmtpServer(metaclass=PoolMeta):
+    __name__ = 'smtp.server'
+    max_messages_per_connection = fields.Integer(
+        'Max. Messages per Connection',
+        help='Number of e-mails sent over one connection before reconnecting.'
+        ' Zero means no limit.')
+    rate_limit = fields.Integer('Rate Limit',
+        help='Maximum number of e-mails sent per minute. Zero means no limit.')
+    delivery_workers = fields.Integer('Delivery Workers',
+        help='Number of connections used in parallel to send a batch of '
+        'e-mails.')
+
+    @classmethod
+    def create(cls, vlist):
+        servers = super().create(vlist)
+        Pool().get('electronic.mail')._default_smtp_server_cache.clear()
+        return servers
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        Pool().get('electronic.mail')._default_smtp_server_cache.clear()
+
+    @classmethod
+    def delete(cls, servers):
+        super().delete(servers)
+        Pool().get('electronic.mail')._default_smtp_server_cache.clear()
+
+    @staticmethod
+    def default_max_messages_per_connection():
+        return MAX_MESSAGES_PER_CONNECTION
+
+    @staticmethod
+    def default_delivery_workers():
+        return DELIVERY_WORKERS
+
+
+class SMTPConnection(object):
+    '''Persistent connection to an SMTP server
+
+    The connection is opened on the first message and reused for the next
+    ones until the maximum number of messages of the server is reached.
+    '''
+
+    def __init__(self, server):
+        self.server = server
+        self.max_messages = server.max_messages_per_connection or 0
+        self._smtp = None
+        self._count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def connect(self):
+        self.close()
+        self._smtp = self.server.get_smtp_server()
+        self._count = 0
+
+    def close(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._smtp = None
+
+    def reset(self):
+        try:
+            self._smtp.rset()
+        except (smtplib.SMTPException, OSError):
+            self.close()
+
+    def send(self, sender, recipients, data):
+        '''Sends the message and returns True if it has been accepted
+
+        Temporary failures (4xx) reset the connection and return False,
+        other errors are raised.
+        '''
+        if (self._smtp is None
+                or (self.max_messages and self._count >= self.max_messages)):
+            self.connect()
+        try:
+            try:
+                self._smtp.sendmail(sender, recipients, data)
+            except (smtplib.SMTPServerDisconnected, OSError) as exception:
+                # The replies of the server are SMTPException which is also
+                # an OSError, only lost connections are sent again
+                if (isinstance(exception, smtplib.SMTPException)
+                        and not isinstance(
+                            exception, smtplib.SMTPServerDisconnected)):
+                    raise
+                self.connect()
+                self._smtp.sendmail(sender, recipients, data)
+        except smtplib.SMTPRecipientsRefused as exception:
+            codes = [code for code, _ in exception.recipients.values()]
+            if not all(400 <= code < 500 for code in codes):
+                raise
+            logger.warning('SMTP server "%s" temporarily refused %s: %s',
+                self.server.rec_name, recipients, exception.recipients)
+            self.reset()
+            return False
+        except smtplib.SMTPResponseException as exception:
+            if not 400 <= exception.smtp_code < 500:
+                raise
+            logger.warning('SMTP server "%s" temporarily refused %s: %s %s',
+                self.server.rec_name, recipients, exception.smtp_code,
+                exception.smtp_error)
+            self.reset()
+            return False
+        self._count += 1
+        return True
+
+
+def deliver(database_name, user, context, server_id, deliveries):
+    '''Sends the deliveries over a connection of its own
+
+    It is meant to run in a worker thread so it starts its own transaction.
+
+    :param deliveries: List of tuples with the mail id, the sender, the
+        recipients and the message
+    :return: List of tuples with the mail id and whether it has been sent:
+        True if it has been accepted, False if the server refused it
+        temporarily and None if it failed
+    '''
+    results = []
+    with Transaction().start(
+            database_name, user, readonly=True, context=context):
+        SMTP = Pool().get('smtp.server')
+        with SMTPConnection(SMTP(server_id)) as connection:
+            for mail_id, sender, recipients, message in deliveries:
+                try:
+                    sent = connection.send(sender, recipients, message)
+                except Exception:
+                    logger.error('Could not send mail ID: %s', mail_id,
+                        exc_info=True)
+                    connection.close()
+                    sent = None
+                results.append((mail_id, sent))
+    return results
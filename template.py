@@ -1,12 +1,22 @@
 # This file is part electronic_mail_template module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import datetime
+import base64
+import hashlib
+import io
 import logging
 import mimetypes
+import multiprocessing
 import re
 import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import markdown
 from email import encoders, charset
+from email.generator import BytesGenerator
 from email.header import Header
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -17,17 +27,44 @@ from genshi.template import TextTemplate
 from html2text import html2text
 from markitdown import (FileConversionException, MarkItDown,
     UnsupportedFormatException)
-from sql import Column
+from sql import Column, Values
 from trytond import backend
+from trytond.cache import Cache
 
 logger = logging.getLogger(__name__)
 
 _TEMPLATE_EXPRESSION_PATTERN = re.compile(
     r'(\{\{.*?\}\}|\{%.*?%\}|\$\{.*?\})',
     re.DOTALL)
+_JINJA2_BLOCK_PATTERN = re.compile(r'\{%[-+]?\s*(?:block|extends)\b')
+# Subscripts like addresses[0] are skipped to follow the path
+_RECORD_PATH_PATTERN = re.compile(
+    r'\brecord((?:\.[A-Za-z_]\w*(?:\[[^\[\]]*\])*)+)')
+_SUBSCRIPT_PATTERN = re.compile(r'\[[^\[\]]*\]')
+_MARKDOWN_EXTENSIONS = ['fenced_code', 'tables', 'sane_lists']
+_markdown_local = threading.local()
+
+
+def _get_markdown():
+    'Returns the Markdown instance of the current thread'
+    converter = getattr(_markdown_local, 'converter', None)
+    if converter is None:
+        converter = markdown.Markdown(extensions=_MARKDOWN_EXTENSIONS)
+        _markdown_local.converter = converter
+    return converter
+
+
+def _get_markitdown():
+    'Returns the MarkItDown instance of the current thread'
+    converter = getattr(_markdown_local, 'markitdown', None)
+    if converter is None:
+        converter = MarkItDown()
+        _markdown_local.markitdown = converter
+    return converter
 
 try:
-    from jinja2 import Template as Jinja2Template
+    from jinja2 import BaseLoader, FileSystemBytecodeCache
+    from jinja2.sandbox import SandboxedEnvironment
     jinja2_loaded = True
 except ImportError:
     jinja2_loaded = False
@@ -35,17 +72,74 @@ except ImportError:
         'Unable to import jinja2. Install jinja2 package.')
 
 import trytond.config as config
-from trytond.model import ModelView, ModelSQL, fields
+from trytond.model import Model, ModelView, ModelSQL, fields
 from trytond.pyson import Eval
 from trytond.pool import Pool
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
 from trytond.transaction import Transaction
-from trytond.modules.electronic_mail_template.tools import unaccent
+from trytond.modules.electronic_mail_template.tools import (
+    LRUCache, TemplateContext, unaccent)
 from trytond.report import Report
-from simpleeval import simple_eval
+from trytond.tools import grouped_slice
+from simpleeval import SimpleEval
 
 QUEUE_NAME = config.get('electronic_mail', 'queue_name', default='default')
+REQUIRED_FIELDS = ('message_id', 'from_', 'to', 'subject', 'markdown')
+OPTIONAL_FIELDS = ('in_reply_to', 'references', 'sender', 'cc', 'bcc')
+RENDER_BATCH_SIZE = config.getint('electronic_mail', 'render_batch_size',
+    default=0)
+COMPILED_CACHE_SIZE = config.getint('electronic_mail', 'compiled_cache_size',
+    default=1024)
+MIGRATION_CHUNK_SIZE = config.getint('electronic_mail', 'migration_chunk_size',
+    default=1000)
+MIGRATION_PROCESSES = config.getint('electronic_mail', 'migration_processes',
+    default=0)
+REPORT_CACHE_SIZE = config.getint('electronic_mail', 'report_cache_size',
+    default=0)
+DEFERRED_BATCH_SIZE = config.getint('electronic_mail', 'deferred_batch_size',
+    default=100)
+REPORT_WORKERS = config.getint('electronic_mail', 'report_workers',
+    default=0)
+REPORT_TIMEOUT = config.getint('electronic_mail', 'report_timeout',
+    default=0)
+SPOOL_MAX_SIZE = config.getint('electronic_mail', 'spool_max_size',
+    default=1024 * 1024)
+JINJA2_BYTECODE_CACHE = config.get('electronic_mail', 'jinja2_bytecode_cache',
+    default=None)
+
+_jinja2_environment = None
+
+if jinja2_loaded:
+    class ExpressionLoader(BaseLoader):
+        'Jinja2 loader whose template names are the expressions themselves'
+
+        def get_source(self, environment, template):
+            return template, None, lambda: True
+
+
+def _get_jinja2_environment():
+    'Returns the sandboxed environment of the jinja2 engine'
+    global _jinja2_environment
+    if _jinja2_environment is None:
+        bytecode_cache = None
+        if JINJA2_BYTECODE_CACHE:
+            bytecode_cache = FileSystemBytecodeCache(JINJA2_BYTECODE_CACHE)
+        environment = SandboxedEnvironment(
+            loader=ExpressionLoader(),
+            bytecode_cache=bytecode_cache,
+            # Compiled templates are kept in Template._compiled_cache
+            cache_size=0,
+            auto_reload=False)
+        environment.filters.update({
+                'format_date': Report.format_date,
+                'format_datetime': Report.format_datetime,
+                'format_timedelta': Report.format_timedelta,
+                'format_currency': Report.format_currency,
+                'format_number': Report.format_number,
+                })
+        _jinja2_environment = environment
+    return _jinja2_environment
 
 
 class Template(ModelSQL, ModelView):
@@ -83,6 +177,32 @@ class Template(ModelSQL, ModelView):
     message_id = fields.Char('Message ID', help='Unique Message Identifier')
     in_reply_to = fields.Char('In Reply To')
     references = fields.Char('References')
+    prefetch = fields.Text('Prefetch Fields',
+        help='Field paths of the record to read in bulk before rendering, one '
+        'per line (e.g. "party.addresses").\n'
+        'If empty, they are detected from the expressions.')
+    coalesce = fields.Char('Coalesce',
+        help='Expression whose value groups the records sent together in a '
+        'single mail with the reports of all of them (e.g. record.party.id).')
+    reuse_mails = fields.Boolean('Reuse Rendered Mails',
+        help='Send again the mail already rendered for a record instead of '
+        'rendering it when neither the record nor the template have been '
+        'modified since.')
+    deferred = fields.Boolean('Deferred Rendering',
+        help='Render and send the mails of triggers from the queue instead '
+        'of in the transaction that fired the trigger.')
+    # Compiled expressions can not be copied nor pickled like the values of
+    # trytond caches so they are kept in a cache of the process
+    _compiled_cache = LRUCache(COMPILED_CACHE_SIZE)
+    # Bounded by the "electronic.mail.template.markdown" key of the [cache]
+    # section
+    _markdown_cache = Cache('electronic.mail.template.markdown',
+        context=False)
+    _signature_cache = Cache('electronic.mail.template.signature',
+        context=False)
+    # Bounded by the total size in bytes of the reports
+    _report_cache = LRUCache(REPORT_CACHE_SIZE,
+        sizeof=lambda report: len(report[1]))
 
     @staticmethod
     def default_engine():
@@ -107,6 +227,16 @@ class Template(ModelSQL, ModelView):
         '''It should be possible to overwrite templates'''
         return True
 
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        cls._compiled_cache.clear()
+
+    @classmethod
+    def delete(cls, templates):
+        super().delete(templates)
+        cls._compiled_cache.clear()
+
     @classmethod
     def __register__(cls, module_name):
         table_handler = cls.__table_handler__(module_name)
@@ -125,6 +255,21 @@ class Template(ModelSQL, ModelView):
 
     @classmethod
     def _migrate_content(cls, cursor, sql_table, has_plain, has_html):
+        executor = None
+        if MIGRATION_PROCESSES > 1:
+            executor = ProcessPoolExecutor(max_workers=MIGRATION_PROCESSES)
+        try:
+            cls._migrate_template_content(
+                cursor, sql_table, has_plain, has_html, executor)
+            cls._migrate_translation_content(cursor, executor)
+            cls._migrate_user_signature(cursor, executor)
+        finally:
+            if executor:
+                executor.shutdown()
+
+    @classmethod
+    def _migrate_template_content(cls, cursor, sql_table, has_plain, has_html,
+            executor=None):
         # 1) Template body: plain/html -> markdown (HTML wins)
         markdown_col = Column(sql_table, 'markdown')
         columns = [sql_table.id, markdown_col]
@@ -133,58 +278,85 @@ class Template(ModelSQL, ModelView):
         if has_plain:
             columns.append(Column(sql_table, 'plain'))
 
-        cursor.execute(*sql_table.select(*columns))
-        rows = list(cursor)
-        for row in rows:
-            if row.get('markdown'):
-                continue
-            source_html = (row.get('html') if has_html else None) or ''
-            source_plain = (row.get('plain') if has_plain else None) or ''
-            source_html = source_html.strip()
-            if source_html:
-                markdown_value = cls._html_to_markdown(source_html)
-            else:
-                markdown_value = source_plain
-            if markdown_value:
-                cursor.execute(*sql_table.update(
-                        [markdown_col], [markdown_value],
-                        where=sql_table.id == row['id']))
+        count = 0
+        for rows in cls._migrate_select(cursor, sql_table, columns):
+            rows = [r for r in rows if not r.get('markdown')]
+            sources_html = [
+                ((row.get('html') if has_html else None) or '').strip()
+                for row in rows]
+            markdown_values = cls._migrate_html_to_markdown(
+                sources_html, executor)
+            to_update = []
+            for row, source_html, markdown_value in zip(
+                    rows, sources_html, markdown_values):
+                if not source_html:
+                    markdown_value = (
+                        (row.get('plain') if has_plain else None) or '')
+                if markdown_value:
+                    to_update.append([row['id'], markdown_value])
+            cls._migrate_update(cursor, sql_table, [markdown_col], to_update)
+            count += len(to_update)
+            logger.info('Migrated %s email template bodies', count)
 
+    @classmethod
+    def _migrate_translation_content(cls, cursor, executor=None):
         # 2) Translations: plain/html -> markdown (HTML wins)
         Translation = Pool().get('ir.translation')
         translation = Translation.__table__()
         name_markdown = '%s,markdown' % cls.__name__
         name_html = '%s,html' % cls.__name__
         name_plain = '%s,plain' % cls.__name__
+        where = ((translation.type == 'model')
+            & (translation.name.in_([name_html, name_plain])))
 
         cursor.execute(*translation.select(
                 translation.id, translation.name, translation.lang,
-                translation.res_id, translation.value, translation.src,
-                where=(translation.type == 'model')
-                & (translation.name.in_([name_html, name_plain]))))
-        rows = list(cursor)
+                translation.res_id,
+                where=where))
         grouped = {}
-        for row in rows:
+        delete_ids = []
+        for row in cursor:
             key = (row['res_id'], row['lang'])
-            if key not in grouped or row['name'] == name_html:
+            if key not in grouped:
+                grouped[key] = row
+            elif row['name'] == name_html:
+                delete_ids.append(grouped[key]['id'])
                 grouped[key] = row
-        keep_ids = {row['id'] for row in grouped.values()}
-        delete_ids = [row['id'] for row in rows if row['id'] not in keep_ids]
-        if delete_ids:
-            cursor.execute(*translation.delete(
-                    where=translation.id.in_(delete_ids)))
-        for row in grouped.values():
-            if row['name'] == name_html:
-                convert = cls._html_to_markdown
             else:
-                convert = lambda value: value or ''
-            new_src = convert(row['src']) if row['src'] else row['src']
-            new_value = convert(row['value']) if row['value'] else row['value']
-            cursor.execute(*translation.update(
-                    [translation.name, translation.src, translation.value],
-                    [name_markdown, new_src, new_value],
-                    where=translation.id == row['id']))
+                delete_ids.append(row['id'])
+        del grouped
+        for sub_ids in grouped_slice(delete_ids):
+            cursor.execute(*translation.delete(
+                    where=translation.id.in_(list(sub_ids))))
+
+        count = 0
+        columns = [translation.id, translation.name, translation.src,
+            translation.value]
+        for rows in cls._migrate_select(
+                cursor, translation, columns, where=where):
+            html_values = [v for row in rows
+                if row['name'] == name_html
+                for v in (row['src'], row['value']) if v]
+            converted = dict(zip(html_values,
+                    cls._migrate_html_to_markdown(html_values, executor)))
+            to_update = []
+            for row in rows:
+                if row['name'] == name_html:
+                    convert = converted.get
+                else:
+                    convert = lambda value: value or ''
+                new_src = convert(row['src']) if row['src'] else row['src']
+                new_value = (convert(row['value']) if row['value']
+                    else row['value'])
+                to_update.append([row['id'], name_markdown, new_src, new_value])
+            cls._migrate_update(cursor, translation,
+                [translation.name, translation.src, translation.value],
+                to_update)
+            count += len(to_update)
+            logger.info('Migrated %s email template translations', count)
 
+    @classmethod
+    def _migrate_user_signature(cls, cursor, executor=None):
         # 3) User signatures: signature_html -> signature (markdown)
         User = Pool().get('res.user')
         table_handler = User.__table_handler__()
@@ -192,24 +364,76 @@ class Template(ModelSQL, ModelView):
                 and table_handler.column_exist('signature_html')):
             return
         user_table = User.__table__()
-        cursor.execute(*user_table.select(
-                user_table.id, user_table.signature,
-                user_table.signature_html))
-        rows = list(cursor)
-        for row in rows:
-            signature_html = (row.get('signature_html') or '').strip()
-            if not signature_html:
-                continue
-            current_signature = (row.get('signature') or '').strip()
-            signature_markdown = cls._html_to_markdown(signature_html)
-            if current_signature and current_signature not in {
-                    signature_html, signature_markdown}:
-                continue
-            if current_signature == signature_html:
-                continue
-            cursor.execute(*user_table.update(
-                    [user_table.signature], [signature_html],
-                    where=user_table.id == row['id']))
+        columns = [user_table.id, user_table.signature,
+            user_table.signature_html]
+        count = 0
+        for rows in cls._migrate_select(cursor, user_table, columns):
+            rows = [r for r in rows
+                if (r.get('signature_html') or '').strip()]
+            signatures_markdown = cls._migrate_html_to_markdown(
+                [r['signature_html'].strip() for r in rows], executor)
+            to_update = []
+            for row, signature_markdown in zip(rows, signatures_markdown):
+                signature_html = row['signature_html'].strip()
+                current_signature = (row.get('signature') or '').strip()
+                if current_signature and current_signature not in {
+                        signature_html, signature_markdown}:
+                    continue
+                if current_signature == signature_html:
+                    continue
+                to_update.append([row['id'], signature_html])
+            cls._migrate_update(
+                cursor, user_table, [user_table.signature], to_update)
+            count += len(to_update)
+            logger.info('Migrated %s user signatures', count)
+
+    @staticmethod
+    def _migrate_select(cursor, table, columns, where=None):
+        '''Yields the rows of the table in chunks
+
+        The rows are paginated by id so no more than a chunk is loaded.
+        '''
+        last_id = None
+        while True:
+            condition = where
+            if last_id is not None:
+                condition = table.id > last_id
+                if where is not None:
+                    condition &= where
+            cursor.execute(*table.select(*columns,
+                    where=condition,
+                    order_by=[table.id.asc],
+                    limit=MIGRATION_CHUNK_SIZE))
+            rows = list(cursor)
+            if not rows:
+                break
+            yield rows
+            last_id = rows[-1]['id']
+
+    @staticmethod
+    def _migrate_update(cursor, table, columns, rows):
+        '''Updates the columns of the rows with a single UPDATE
+
+        :param rows: List of lists with the id followed by the column values
+        '''
+        if not rows:
+            return
+        values = Values(rows)
+        cursor.execute(*table.update(
+                columns,
+                [Column(values, 'column%s' % (i + 2))
+                    for i in range(len(columns))],
+                from_=[values],
+                where=table.id == Column(values, 'column1')))
+
+    @classmethod
+    def _migrate_html_to_markdown(cls, values, executor=None):
+        if executor is None or len(values) < 2:
+            return cls._html_to_markdown_batch(values)
+        size = -(-len(values) // MIGRATION_PROCESSES)
+        chunks = [values[i:i + size] for i in range(0, len(values), size)]
+        return [v for result in executor.map(_html_to_markdown_batch, chunks)
+            for v in result]
 
     def eval(self, expression, record):
         '''Evaluates the given :attr:expression
@@ -218,7 +442,99 @@ class Template(ModelSQL, ModelView):
         :param record: The browse record of the record
         '''
         engine_method = getattr(self, '_engine_' + self.engine)
-        return engine_method(expression, record)
+        return engine_method(
+            expression, record, self._get_template_context(record))
+
+    def eval_fields(self, values, record):
+        '''Evaluates the expressions of the mail fields in values
+
+        The optional fields are only evaluated when they have an expression.
+        Engines with an ``_engine_<engine>_fields`` method evaluate all of
+        them in a single invocation.
+
+        :param values: Dictionary with the expression of each field
+        :param record: The browse record of the record
+        :return: Dictionary with the evaluated value of each field
+        '''
+        expressions = {}
+        for field_name in REQUIRED_FIELDS + OPTIONAL_FIELDS:
+            if field_name in REQUIRED_FIELDS or values.get(field_name):
+                expressions[field_name] = values.get(field_name)
+        template_context = self._get_template_context(record)
+        engine_method = getattr(self, '_engine_%s_fields' % self.engine, None)
+        if engine_method:
+            return engine_method(expressions, record, template_context)
+        engine_method = getattr(self, '_engine_' + self.engine)
+        return {name: engine_method(expression, record, template_context)
+            for name, expression in expressions.items()}
+
+    def _get_template_context(self, record):
+        '''Returns the template context of the record
+
+        The context is built once and reused by all the expressions evaluated
+        for the same record and language.
+        '''
+        language = Transaction().language
+        cached = getattr(self, '_template_context', None)
+        if cached and cached[0] is record and cached[1] == language:
+            return cached[2]
+        template_context = TemplateContext(self.template_context(record))
+        self._template_context = (record, language, template_context)
+        return template_context
+
+    @classmethod
+    def compile(cls, engine, expression):
+        '''Returns the compiled expression for the engine
+
+        Compiled expressions are kept in a process-wide LRU cache keyed by
+        engine and source so that the same expression is only parsed once.
+        Engines without a ``_compile_<engine>`` method return the expression
+        unchanged.
+        '''
+        compile_method = getattr(cls, '_compile_' + engine, None)
+        if compile_method is None:
+            return expression
+        key = (engine, expression)
+        compiled = cls._compiled_cache.get(key)
+        if compiled is None:
+            compiled = compile_method(expression)
+            cls._compiled_cache.set(key, compiled)
+        return compiled
+
+    @classmethod
+    def compiled_cache_stats(cls):
+        '''Returns the hits and misses of the compiled expression cache'''
+        return {
+            'hit': cls._compiled_cache.hit,
+            'miss': cls._compiled_cache.miss,
+            }
+
+    @staticmethod
+    def _compile_python(expression):
+        return SimpleEval.parse(expression)
+
+    @staticmethod
+    def _compile_genshi(expression):
+        return TextTemplate(expression)
+
+    @staticmethod
+    def _compile_jinja2(expression):
+        return _get_jinja2_environment().get_template(expression)
+
+    @classmethod
+    def _compile_jinja2_fields(cls, expressions):
+        blocks = []
+        for name, expression in expressions:
+            expression = expression or ''
+            # Like a standalone template, drop a single trailing newline of
+            # the source
+            for newline in ('\r\n', '\r', '\n'):
+                if expression.endswith(newline):
+                    expression = expression[:-len(newline)]
+                    break
+            blocks.append(
+                '{%% block %s %%}%s{%% endblock %%}' % (name, expression))
+        return cls._compile_jinja2(''.join(blocks))
 
     @staticmethod
     def template_context(record):
@@ -241,31 +557,34 @@ class Template(ModelSQL, ModelView):
             }
 
     @classmethod
-    def _engine_python(cls, expression, record):
+    def _engine_python(cls, expression, record, template_context=None):
         '''Evaluate the pythonic expression and return its value
         '''
         if expression is None:
             return ''
 
         assert record is not None, 'Record is undefined'
-        template_context = cls.template_context(record)
-        return simple_eval(
-            expression,
+        if template_context is None:
+            template_context = TemplateContext(cls.template_context(record))
+        parsed = cls.compile('python', expression)
+        evaluator = SimpleEval(
             names=template_context,
-            functions={k: v for k, v in template_context.items()
-                if callable(v)})
+            functions=template_context.functions)
+        return evaluator.eval(expression, previously_parsed=parsed)
 
     @classmethod
-    def _engine_genshi(cls, expression, record):
+    def _engine_genshi(cls, expression, record, template_context=None):
         '''
         :param expression: Expression to evaluate
         :param record: Browse record
+        :param template_context: Template context of the record
         '''
         if not expression:
             return ''
 
-        template = TextTemplate(expression)
-        template_context = cls.template_context(record)
+        template = cls.compile('genshi', expression)
+        if template_context is None:
+            template_context = cls.template_context(record)
 
         try:
             return template.generate(**template_context).render(
@@ -276,18 +595,49 @@ class Template(ModelSQL, ModelView):
                 error=repr(message)))
 
     @classmethod
-    def _engine_jinja2(cls, expression, record):
+    def _engine_jinja2(cls, expression, record, template_context=None):
         '''
         :param expression: Expression to evaluate
         :param record: Browse record
+        :param template_context: Template context of the record
         '''
         if not jinja2_loaded or not expression:
             return ''
 
-        template = Jinja2Template(expression)
-        template_context = cls.template_context(record)
+        template = cls.compile('jinja2', expression)
+        if template_context is None:
+            template_context = cls.template_context(record)
         return template.render(template_context)
 
+    @classmethod
+    def _engine_jinja2_fields(cls, expressions, record,
+            template_context=None):
+        '''Evaluates all the expressions with a single Jinja2 template
+
+        Each expression is a block of the template so it is compiled once and
+        all the blocks are rendered with the same context. Expressions that
+        define blocks or extend templates are evaluated one by one.
+
+        :param expressions: Dictionary with the expression of each field
+        :param record: Browse record
+        :param template_context: Template context of the record
+        '''
+        if not jinja2_loaded:
+            return {name: '' for name in expressions}
+        if any(_JINJA2_BLOCK_PATTERN.search(e)
+                for e in expressions.values() if e):
+            return {name: cls._engine_jinja2(
+                        expression, record, template_context)
+                for name, expression in expressions.items()}
+
+        template = cls.compile(
+            'jinja2_fields', tuple(sorted(expressions.items())))
+        if template_context is None:
+            template_context = cls.template_context(record)
+        context = template.new_context(template_context)
+        return {name: ''.join(template.blocks[name](context))
+            for name in expressions}
+
     @staticmethod
     def _get_policy():
         # See https://docs.python.org/3/library/email.policy.html
@@ -297,21 +647,32 @@ class Template(ModelSQL, ModelView):
     def _html_to_markdown(value):
         if not value:
             return ''
-        converter = MarkItDown()
+        converter = _get_markitdown()
         try:
-            with tempfile.NamedTemporaryFile(
-                    mode='w', suffix='.html', encoding='utf-8') as f:
-                f.write(value)
-                f.flush()
-                result = converter.convert(f.name)
-                text = result.text_content.replace('\x00', '').strip()
-                return Template._unescape_template_expressions(text)
+            result = converter.convert_stream(
+                io.BytesIO(value.encode('utf-8')), file_extension='.html')
+            text = result.text_content.replace('\x00', '').strip()
+            return Template._unescape_template_expressions(text)
         except (FileConversionException, UnsupportedFormatException) as exc:
             logger.error(
                 'MarkItDown conversion error while processing HTML content: %s',
                 exc, exc_info=True)
         return ''
 
+    @classmethod
+    def _html_to_markdown_batch(cls, values):
+        '''Converts a list of HTML values to markdown
+
+        Repeated values are only converted once.
+        '''
+        converted = {}
+        result = []
+        for value in values:
+            if value not in converted:
+                converted[value] = cls._html_to_markdown(value)
+            result.append(converted[value])
+        return result
+
     @staticmethod
     def _unescape_template_expressions(value):
         if not value:
@@ -323,30 +684,63 @@ class Template(ModelSQL, ModelView):
         return _TEMPLATE_EXPRESSION_PATTERN.sub(replace, value)
 
     @classmethod
-    def _markdown_to_html(cls, value):
+    def _markdown_convert(cls, value):
+        '''Returns a tuple with the HTML and the plain text of the markdown
+
+        Both are produced from a single parse and cached by content hash.
+        '''
         if not value:
-            return ''
-        return markdown.markdown(
-            value, extensions=['fenced_code', 'tables', 'sane_lists'])
+            return '', ''
+        key = hashlib.sha256(value.encode('utf-8')).hexdigest()
+        result = cls._markdown_cache.get(key)
+        if result is None:
+            converter = _get_markdown()
+            try:
+                html = converter.convert(value)
+            finally:
+                converter.reset()
+            plain = html2text(html, bodywidth=0).strip() if html else ''
+            result = (html, plain)
+            cls._markdown_cache.set(key, result)
+        return result
+
+    @classmethod
+    def _markdown_to_html(cls, value):
+        return cls._markdown_convert(value)[0]
 
     @classmethod
     def _markdown_to_plain(cls, value):
-        if not value:
-            return ''
-        html = cls._markdown_to_html(value)
-        if not html:
-            return ''
-        return html2text(html, bodywidth=0).strip()
+        return cls._markdown_convert(value)[1]
+
+    @classmethod
+    def _get_signature_markdown(cls, user):
+        '''Returns the signature of the user as markdown
+
+        The converted signature is cached by user and its write date.
+        '''
+        key = (user.id, user.write_date)
+        signature_markdown = cls._signature_cache.get(key)
+        if signature_markdown is not None:
+            return signature_markdown
+        signature_markdown = (user.signature or '').strip()
+        if ('<' in signature_markdown and '>' in signature_markdown):
+            converted_signature = cls._html_to_markdown(signature_markdown)
+            if converted_signature:
+                signature_markdown = converted_signature
+        cls._signature_cache.set(key, signature_markdown)
+        return signature_markdown
 
     @classmethod
     def render(cls, template, record, values, render_report=True,
-            extra_attachments=None):
+            extra_attachments=None, reports=None):
         '''Renders the template and returns as email object
         :param template: Browse Record of the template
         :param record: Browse Record of the record on which the template
             is to generate the data on
         :param extra_attachments: A dictionary with 2 keys 'filename' and
             'data' to attach external documents.
+        :param reports: List of already rendered reports as returned by
+            render_reports to use instead of rendering them.
         :return: 'email.message.Message' instance
         '''
         # It is hard to write correct e-mails even using the email module.
@@ -357,35 +751,28 @@ class Template(ModelSQL, ModelView):
         # that conversion automatically.
         ElectronicMail = Pool().get('electronic.mail')
 
+        evaluated = template.eval_fields(values, record)
         message = MIMEMultipart(policy=cls._get_policy())
-        messageid = template.eval(values['message_id'], record)
-        message['Message-Id'] = messageid or make_msgid()
+        message['Message-Id'] = evaluated['message_id'] or make_msgid()
         message['Date'] = formatdate(localtime=1)
         if values.get('in_reply_to'):
-            message['In-Reply-To'] = template.eval(values['in_reply_to'],
-                record)
+            message['In-Reply-To'] = evaluated['in_reply_to']
         if values.get('references'):
-            message['References'] = template.eval(values['references'],
-                record)
-        message['From'] = ElectronicMail.validate_emails(
-            template.eval(values['from_'], record))
+            message['References'] = evaluated['references']
+        message['From'] = ElectronicMail.validate_emails(evaluated['from_'])
         if values.get('sender'):
             message['Sender'] = ElectronicMail.validate_emails(
-                template.eval(values['sender'], record))
-        message['To'] = ElectronicMail.validate_emails(
-            template.eval(values['to'], record))
+                evaluated['sender'])
+        message['To'] = ElectronicMail.validate_emails(evaluated['to'])
         if values.get('cc'):
-            message['Cc'] = ElectronicMail.validate_emails(
-                template.eval(values['cc'], record))
+            message['Cc'] = ElectronicMail.validate_emails(evaluated['cc'])
         if values.get('bcc'):
-            message['Bcc'] = ElectronicMail.validate_emails(
-                template.eval(values['bcc'], record))
+            message['Bcc'] = ElectronicMail.validate_emails(evaluated['bcc'])
 
-        message['Subject'] = Header(template.eval(values['subject'],
-                record), 'utf-8').encode()
+        message['Subject'] = Header(evaluated['subject'], 'utf-8').encode()
 
         # HTML & Text Alternate parts
-        markdown_text = template.eval(values['markdown'], record)
+        markdown_text = evaluated['markdown']
         header = """
             <html>
             <head><head>
@@ -398,11 +785,7 @@ class Template(ModelSQL, ModelView):
         if template.signature:
             User = Pool().get('res.user')
             user = User(Transaction().user)
-            signature_markdown = (user.signature or '').strip()
-            if ('<' in signature_markdown and '>' in signature_markdown):
-                converted_signature = cls._html_to_markdown(signature_markdown)
-                if converted_signature:
-                    signature_markdown = converted_signature
+            signature_markdown = cls._get_signature_markdown(user)
             if signature_markdown:
                 if markdown_text:
                     markdown_text = '%s\n\n--\n%s' % (
@@ -410,8 +793,7 @@ class Template(ModelSQL, ModelView):
                 else:
                     markdown_text = '--\n%s' % signature_markdown
 
-        html_body = cls._markdown_to_html(markdown_text)
-        plain = cls._markdown_to_plain(markdown_text)
+        html_body, plain = cls._markdown_convert(markdown_text)
         html = ''
         if html_body:
             html = "%s%s%s" % (header, html_body, footer)
@@ -436,44 +818,112 @@ class Template(ModelSQL, ModelView):
         if body:
             message.attach(body)
 
+        for filename, data in cls._get_render_attachments(template, record,
+                render_report, reports, extra_attachments):
+            message.attach(cls._get_attachment(filename, data))
+
+        return message
+
+    @classmethod
+    def _get_render_attachments(cls, template, record, render_report=True,
+            reports=None, extra_attachments=None):
+        '''Returns the attachments of the mail as a list of tuples with the
+        file name and the data
+        '''
+        attachments = []
         # Attach reports
-        if render_report and template.reports:
-            reports = cls.render_reports(template, record)
+        if render_report and (template.reports or reports):
+            if reports is None:
+                reports = cls.render_reports(template, record)
             for report in reports:
                 ext, data, filename, file_name = report[0:5]
                 if file_name:
                     filename = template.eval(file_name, record)
                 filename = unaccent(filename)
                 filename = ext and '%s.%s' % (filename, ext) or filename
-                content_type, _ = mimetypes.guess_type(filename)
-                maintype, subtype = (
-                    content_type or 'application/octet-stream'
-                    ).split('/', 1)
-
-                attachment = MIMEBase(maintype, subtype,
-                    policy=cls._get_policy())
-                attachment.set_payload(data)
-                encoders.encode_base64(attachment)
-                attachment.add_header(
-                    'Content-Disposition', 'attachment', filename=filename)
-                message.attach(attachment)
+                attachments.append((filename, data))
         if extra_attachments:
             for attach in extra_attachments:
-                filename = attach['name']
-                content_type, _ = mimetypes.guess_type(filename)
-                maintype, subtype = (
-                    content_type or 'application/octet-stream'
-                    ).split('/', 1)
-
-                attachment = MIMEBase(maintype, subtype,
-                    policy=cls._get_policy())
-                attachment.set_payload(attach['data'])
-                encoders.encode_base64(attachment)
-                attachment.add_header(
-                    'Content-Disposition', 'attachment', filename=filename)
-                message.attach(attachment)
+                attachments.append((attach['name'], attach['data']))
+        return attachments
 
-        return message
+    @classmethod
+    def _get_attachment(cls, filename, data=None):
+        '''Returns the MIME part of the attachment
+
+        Without data only the headers of the part are set.
+        '''
+        content_type, _ = mimetypes.guess_type(filename)
+        maintype, subtype = (
+            content_type or 'application/octet-stream'
+            ).split('/', 1)
+
+        attachment = MIMEBase(maintype, subtype, policy=cls._get_policy())
+        if data is not None:
+            attachment.set_payload(data)
+            encoders.encode_base64(attachment)
+        else:
+            attachment['Content-Transfer-Encoding'] = 'base64'
+            attachment.set_payload('')
+        attachment.add_header(
+            'Content-Disposition', 'attachment', filename=filename)
+        return attachment
+
+    @classmethod
+    def render_to_file(cls, template, record, values, render_report=True,
+            extra_attachments=None, reports=None):
+        '''Renders the template and writes the message to a spooled file
+
+        The attachments are base64 encoded straight into the file part by
+        part, so they are never held encoded in memory.
+        :return: Tuple with the message without the attachments and the file
+            positioned at its start
+        '''
+        message = cls.render(template, record, values, render_report=False)
+        attachments = cls._get_render_attachments(template, record,
+            render_report, reports, extra_attachments)
+        mail_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        cls._write_message(message, attachments, mail_file)
+        mail_file.seek(0)
+        return message, mail_file
+
+    @classmethod
+    def _write_message(cls, message, attachments, file):
+        '''Writes the message followed by the attachments to the file
+
+        :param attachments: List of tuples with the file name and the data
+        '''
+        linesep = cls._get_policy().linesep.encode()
+        buffer = io.BytesIO()
+        BytesGenerator(buffer, mangle_from_=False,
+            policy=cls._get_policy()).flatten(message)
+        content = buffer.getvalue()
+        if not attachments:
+            file.write(content)
+            return
+
+        boundary = ('--%s' % message.get_boundary()).encode()
+        # Remove the close delimiter to append the attachments
+        content = content[:content.rindex(boundary + b'--')]
+        file.write(content)
+        del buffer, content
+        for filename, data in attachments:
+            file.write(boundary + linesep)
+            buffer = io.BytesIO()
+            BytesGenerator(buffer, mangle_from_=False,
+                policy=cls._get_policy()).flatten(
+                cls._get_attachment(filename))
+            file.write(buffer.getvalue())
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            view = memoryview(data)
+            # 57 bytes are encoded into a line of 76 characters
+            step = 57 * 1024
+            for i in range(0, len(view), step):
+                file.write(base64.encodebytes(view[i:i + step]).replace(
+                        b'\n', linesep))
+            file.write(linesep)
+        file.write(boundary + b'--' + linesep)
 
     @classmethod
     def render_reports(cls, template, record):
@@ -488,37 +938,25 @@ class Template(ModelSQL, ModelView):
             the report name
             the report file name (optional)
         '''
-        pool = Pool()
-        ActionReport = pool.get('ir.action.report')
-        Lang = pool.get('ir.lang')
+        ActionReport = Pool().get('ir.action.report')
 
         if isinstance(record, list):
-            ids = [r.id for r in record]
+            records = record
             record = record[0]
         else:
-            ids = [record.id]
+            records = [record]
+        ids = [r.id for r in records]
 
         lang = Transaction().language
         if template.language:
             lang = template.eval(template.language, record) or lang
 
-        html_report_language = None
-        if lang:
-            langs = Lang.search([('code', '=', lang)], limit=1)
-            html_report_language = langs[0] if langs else None
-
+        context = cls._get_report_context(lang)
         reports = []
         for report_action in template.reports:
-            context = {'language': lang}
-            if html_report_language:
-                context.update({
-                    'html_report_language': html_report_language,
-                    'report_lang': html_report_language.code,
-                    })
             with Transaction().set_context(**context):
                 report_action = ActionReport(report_action.id)
-                report = Pool().get(report_action.report_name, type='report')
-                report_execute = report.execute(ids, {
+                report_execute = cls._execute_report(report_action, records, {
                     'model': report_action.model,
                     'id': ids[0],
                     'ids': ids,
@@ -530,51 +968,394 @@ class Template(ModelSQL, ModelView):
         # The boolean for direct print in the tuple is useless for emails
         return [(r[0][0], r[0][1], r[0][3], r[1]) for r in reports]
 
+    @staticmethod
+    def _get_render_values(template):
+        values = {'template': template}
+        tmpl_fields = ('from_', 'sender', 'to', 'cc', 'bcc', 'subject',
+            'message_id', 'in_reply_to', 'references', 'markdown')
+        for field_name in tmpl_fields:
+            values[field_name] = getattr(template, field_name)
+        return values
+
+    @staticmethod
+    def _get_report_context(lang):
+        '''Returns the context to execute the reports in the language'''
+        Lang = Pool().get('ir.lang')
+
+        context = {'language': lang}
+        if lang:
+            langs = Lang.search([('code', '=', lang)], limit=1)
+            if langs:
+                context.update({
+                    'html_report_language': langs[0],
+                    'report_lang': langs[0].code,
+                    })
+        return context
+
     @classmethod
-    def render_and_send(cls, template_id, records):
+    def render_reports_batch(cls, template, records, language=None,
+            parallel=False):
+        '''Renders the reports of the template for each one of the records
+
+        The report actions and the language are loaded once for all the
+        records instead of once per record.
+
+        :param template: Browse Record of the template
+        :param records: List Browse Record of the records
+        :param language: Language code to render the reports in
+        :param parallel: Whether to render them in the pool of report
+            workers, only possible when the records are committed
+        :return: Dictionary with the record id as key and the list of tuples
+            returned by render_reports as value
+        '''
+        ActionReport = Pool().get('ir.action.report')
+
+        if parallel and REPORT_WORKERS > 1 and len(records) > 1:
+            return cls._render_reports_parallel(template, records, language)
+
+        context = cls._get_report_context(
+            language or Transaction().language)
+        reports = defaultdict(list)
+        with Transaction().set_context(**context):
+            report_actions = ActionReport.browse(
+                [r.id for r in template.reports])
+            for report_action in report_actions:
+                for record in records:
+                    report_execute = cls._execute_report(
+                        report_action, [record], {
+                            'model': report_action.model,
+                            'id': record.id,
+                            'ids': [record.id],
+                            'action_id': report_action.id,
+                            })
+                    if not report_execute:
+                        continue
+                    # The boolean for direct print is useless for emails
+                    reports[record.id].append((report_execute[0],
+                            report_execute[1], report_execute[3],
+                            report_action.file_name))
+        return reports
+
+    @classmethod
+    def _render_reports_parallel(cls, template, records, language=None):
+        '''Renders the reports of each record in a pool of worker processes
+
+        Each worker starts its own transaction so the records must be
+        committed, like when rendering from the queue. The records whose
+        reports fail or exceed the report timeout get None. The workers are
+        terminated once the batch is done, so none is left running after a
+        timeout.
+        '''
+        transaction = Transaction()
+        database_name = transaction.database.name
+        # Fork so the workers share the configuration and the pool
+        workers = multiprocessing.get_context('fork').Pool(REPORT_WORKERS,
+            initializer=_init_report_worker, initargs=(database_name,))
+        try:
+            results = {record.id: workers.apply_async(_render_record_reports,
+                    (database_name, transaction.user,
+                        dict(transaction.context), template.id, str(record),
+                        language))
+                for record in records}
+            deadline = None
+            if REPORT_TIMEOUT:
+                deadline = time.monotonic() + REPORT_TIMEOUT
+            reports = {}
+            for record_id, result in results.items():
+                reports[record_id] = None
+                timeout = None
+                if deadline is not None:
+                    timeout = max(deadline - time.monotonic(), 0)
+                try:
+                    reports[record_id] = result.get(timeout)
+                except multiprocessing.TimeoutError:
+                    logger.warning(
+                        'Timeout rendering reports of template %s for %s',
+                        template.id, record_id)
+                except Exception:
+                    logger.error(
+                        'Error rendering reports of template %s for %s',
+                        template.id, record_id, exc_info=True)
+        finally:
+            workers.terminate()
+            workers.join()
+        return reports
+
+    @classmethod
+    def _execute_report(cls, report_action, records, data):
+        '''Executes the report action for the records
+
+        When the report cache is enabled, the result is reused while neither
+        the report action nor the records have been modified. It is kept
+        apart for each user, company and employee as the report may depend on
+        them. The least recently used reports are evicted once their total
+        size exceeds electronic_mail.report_cache_size bytes.
+        '''
+        Report = Pool().get(report_action.report_name, type='report')
+        ids = [r.id for r in records]
+        if not REPORT_CACHE_SIZE:
+            return Report.execute(ids, data)
+
+        transaction = Transaction()
+        key = (transaction.database.name, transaction.user,
+            transaction.context.get('company'),
+            transaction.context.get('employee'), report_action.id,
+            str(report_action.write_date or report_action.create_date),
+            tuple(ids), transaction.language,
+            tuple(str(r.write_date or r.create_date) for r in records))
+        result = cls._report_cache.get(key)
+        if result is None:
+            result = Report.execute(ids, data)
+            if result:
+                cls._report_cache.set(key, result)
+        return result
+
+    @classmethod
+    def render_and_send(cls, template_id, records, parallel_reports=False):
         """
         Render the template and send
         :param template_id: ID template
         :param records: List Object of the records
+        :param parallel_reports: Render the records in batches with their
+            reports in the pool of report workers. The records must be
+            committed.
         """
         pool = Pool()
         Configuration = pool.get('electronic.mail.configuration')
-        ElectronicEmail = pool.get('electronic.mail')
         Template = pool.get('electronic.mail.template')
 
         template = cls(template_id)
         config = Configuration(1)
 
+        groups = cls._group_records_by_language(template, records)
+        for language, sub_records in groups.items():
+            # load data in language once for all the records in the language
+            with Transaction().set_context(language=language):
+                template = Template(template.id)
+            values = cls._get_render_values(template)
+            cls._prefetch(template, sub_records)
+
+            if template.coalesce:
+                cls._render_and_send_batch(
+                    template, values, language, sub_records, config,
+                    parallel_reports=parallel_reports)
+                continue
+            if template.reuse_mails:
+                sub_records = cls._reuse_rendered_mails(
+                    template, language, sub_records, config)
+            # Without batches, each mail is enqueued on its own
+            batch_size = RENDER_BATCH_SIZE or (None if parallel_reports else 1)
+            for chunk in grouped_slice(sub_records, batch_size):
+                cls._render_and_send_batch(
+                    template, values, language, list(chunk), config,
+                    parallel_reports=parallel_reports)
+        return True
+
+    def get_prefetch_paths(self):
+        '''Returns the field paths of the record used by the template
+
+        The paths are taken from the prefetch field or, if it is empty,
+        detected from the expressions of the template and its reports.
+        :return: List of tuples with the field names of each path
+        '''
+        if self.prefetch:
+            paths = {tuple(p.strip().split('.'))
+                for p in self.prefetch.splitlines() if p.strip()}
+        else:
+            expressions = [getattr(self, f) for f in (
+                    REQUIRED_FIELDS + OPTIONAL_FIELDS + ('language',))]
+            expressions += [r.file_name for r in self.reports]
+            paths = {
+                tuple(_SUBSCRIPT_PATTERN.sub('', m.group(1))[1:].split('.'))
+                for e in expressions if e
+                for m in _RECORD_PATH_PATTERN.finditer(e)}
+        # Reading the longest paths reads also their prefixes
+        return sorted(p for p in paths
+            if not any(o[:len(p)] == p and o != p for o in paths))
+
+    @classmethod
+    def _prefetch(cls, template, records):
+        '''Reads in bulk the fields of the records used by the template
+
+        Each level of the paths is accessed for all the records together so
+        that Tryton reads it with a single query per model and fills the
+        transaction cache used when rendering each record.
+        '''
+        for path in template.get_prefetch_paths():
+            values = list(records)
+            for name in path:
+                next_values = []
+                for value in values:
+                    if (not isinstance(value, Model)
+                            or name not in value._fields):
+                        continue
+                    value = getattr(value, name)
+                    if isinstance(value, (list, tuple)):
+                        next_values.extend(value)
+                    elif value is not None:
+                        next_values.append(value)
+                values = next_values
+                if not values:
+                    break
+
+    @classmethod
+    def _group_records_by_language(cls, template, records):
+        """
+        Evaluate the language of all the records and group them by language
+        :param template: Browse record of the template
+        :param records: List Object of the records
+        :return: Dictionary with the language as key and the list of records
+        """
+        groups = {}
+        default_language = Transaction().context.get('language')
         for record in records:
-            # load data in language when send a record
             if template.language:
                 language = template.eval(template.language, record)
             else:
-                language = Transaction().context.get('language')
+                language = default_language
+            groups.setdefault(language, []).append(record)
+        return groups
 
-            with Transaction().set_context(language=language):
-                template = Template(template.id)
+    @classmethod
+    def _render_and_send_batch(cls, template, values, language, records,
+            config, parallel_reports=False):
+        """
+        Render the template for a chunk of records, create the mails one at a
+        time and enqueue them in a single task
+        Each mail is created as soon as it is rendered so only one serialized
+        message, and the reports of as many mails as report workers, are held
+        in memory.
+        When the template has a coalesce expression, the records with the
+        same value are merged in a single mail with all their reports.
+        :param template: Browse record of the template in the language
+        :param values: Dictionary with the values of the template fields
+        :param language: Language code to render the records in
+        :param records: List Object of the records
+        :param config: Browse record of the mail configuration
+        :param parallel_reports: Render the reports in the pool of report
+            workers
+        """
+        ElectronicEmail = Pool().get('electronic.mail')
+
+        with Transaction().set_context(language=language):
+            groups = cls._coalesce_records(template, records)
+        size = 1
+        if parallel_reports and REPORT_WORKERS > 1:
+            size = REPORT_WORKERS
+        to_send = []
+        for sub_groups in grouped_slice(groups, size):
+            sub_groups = list(sub_groups)
+            reports = {}
+            if template.reports:
+                reports = cls.render_reports_batch(template,
+                    [r for g in sub_groups for r in g], language,
+                    parallel=parallel_reports)
+            for group in sub_groups:
+                record = group[0]
+                mailbox = template.mailbox
+                draft = False
+                group_reports = []
+                with Transaction().set_context(language=language):
+                    for group_record in group:
+                        record_reports = reports.get(group_record.id, [])
+                        # Reports that could not be rendered leave the mail
+                        # as draft
+                        if record_reports is None:
+                            mailbox = template.draft_mailbox
+                            draft = True
+                            continue
+                        if len(group) == 1:
+                            group_reports.extend(record_reports)
+                            continue
+                        # Name the reports of each record from its own values
+                        for ext, data, filename, file_name in record_reports:
+                            if file_name:
+                                filename = template.eval(
+                                    file_name, group_record)
+                            group_reports.append((ext, data, filename, None))
+                    mail_message, mail_file = cls.render_to_file(
+                        template, record, values, reports=group_reports)
+                mail_values = None
+                if template.reuse_mails and not template.coalesce:
+                    mail_values = [{
+                            'render_key': cls._get_render_key(
+                                template, record, language),
+                            }]
+                with mail_file:
+                    electronic_mail, = ElectronicEmail.create_from_mails(
+                        [(mail_message, mailbox, record, mail_file)],
+                        template=template, values=mail_values)
+                if not draft:
+                    to_send.append(electronic_mail)
+        if not to_send:
+            return
+        with Transaction().set_context(
+                queue_name=QUEUE_NAME,
+                queue_scheduled_at=config.send_email_after):
+            ElectronicEmail.__queue__.send_mail(to_send)
 
-            values = {'template': template}
-            tmpl_fields = ('from_', 'sender', 'to', 'cc', 'bcc', 'subject',
-                'message_id', 'in_reply_to', 'references', 'markdown')
-            for field_name in tmpl_fields:
-                values[field_name] = getattr(template, field_name)
+    @staticmethod
+    def _get_render_key(template, record, language):
+        """
+        Return the key of the mail rendered by the template for the record
+        It changes when the template or the record are modified.
+        """
+        write_date = (getattr(record, 'write_date', None)
+            or getattr(record, 'create_date', None))
+        key = (template.id, str(template.write_date or template.create_date),
+            str(record), str(write_date), language)
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
 
-            with Transaction().set_context(language=language):
-                mail_message = cls.render(template, record, values)
-            electronic_mail = ElectronicEmail.create_from_mail(
-                mail_message, template.mailbox.id, record)
-            if not electronic_mail:
-                continue
-            electronic_mail.template = template
-            electronic_mail.save()
+    @classmethod
+    def _reuse_rendered_mails(cls, template, language, records, config):
+        """
+        Send again the mails already rendered by the template for the records
+        in the language if none of them has been modified since
+        Sent mails are copied so they are sent again without rendering them.
+        :return: List of the records that must be rendered
+        """
+        ElectronicEmail = Pool().get('electronic.mail')
+
+        keys = {cls._get_render_key(template, r, language): r
+            for r in records}
+        reused = {}
+        for sub_keys in grouped_slice(list(keys)):
+            mails = ElectronicEmail.search([
+                    ('template', '=', template.id),
+                    ('mailbox', '=', template.mailbox.id),
+                    ('render_key', 'in', list(sub_keys)),
+                    ], order=[('id', 'ASC')])
+            for mail in mails:
+                reused[mail.render_key] = mail
+        if not reused:
+            return records
+
+        to_send = [m for m in reused.values() if not m.flag_send]
+        to_copy = [m for m in reused.values() if m.flag_send]
+        if to_copy:
+            to_send += ElectronicEmail.copy(
+                to_copy, default={'flag_send': False})
+        with Transaction().set_context(
+                queue_name=QUEUE_NAME,
+                queue_scheduled_at=config.send_email_after):
+            ElectronicEmail.__queue__.send_mail(to_send)
+        return [r for k, r in keys.items() if k not in reused]
 
-            with Transaction().set_context(
-                    queue_name=QUEUE_NAME,
-                    queue_scheduled_at=config.send_email_after):
-                ElectronicEmail.__queue__.send_mail([electronic_mail])
-        return True
+    @classmethod
+    def _coalesce_records(cls, template, records):
+        """
+        Group the records that must be sent in the same mail
+        :param template: Browse record of the template
+        :param records: List Object of the records
+        :return: List of lists of records
+        """
+        if not template.coalesce:
+            return [[r] for r in records]
+        groups = {}
+        for record in records:
+            key = template.eval(template.coalesce, record)
+            groups.setdefault(key, []).append(record)
+        return list(groups.values())
 
     @classmethod
     def mail_from_trigger(cls, records, trigger_id):
@@ -589,32 +1370,108 @@ class Template(ModelSQL, ModelView):
         """
         Trigger = Pool().get('ir.trigger')
         trigger = Trigger(trigger_id)
-        return cls.render_and_send(trigger.email_template.id, records)
+        template = trigger.email_template
+        if template.deferred and records:
+            return cls.enqueue_render_and_send(template, records)
+        return cls.render_and_send(template.id, records)
+
+    @classmethod
+    def enqueue_render_and_send(cls, template, records):
+        """
+        Enqueue the rendering and sending of the records in chunks
+        :param template: Browse record of the template
+        :param records: List Object of the records
+        """
+        now = datetime.datetime.now()
+        with Transaction().set_context(queue_name=QUEUE_NAME):
+            for sub_records in grouped_slice(records, DEFERRED_BATCH_SIZE):
+                cls.__queue__.render_and_send_deferred([template],
+                    records[0].__name__, [r.id for r in sub_records], now)
+        return True
+
+    @classmethod
+    def render_and_send_deferred(cls, templates, model, record_ids,
+            enqueued_at=None):
+        """
+        Render and send the records from the queue
+        Records that already got a mail from the template since the task was
+        enqueued are skipped so running the task again does not resend them.
+        A coalesced mail only refers to the first record of its group, so the
+        whole group is skipped.
+        :param templates: List of templates
+        :param model: Name of the model of the records
+        :param record_ids: List of the record ids
+        :param enqueued_at: Date time when the task was enqueued
+        """
+        pool = Pool()
+        ElectronicEmail = pool.get('electronic.mail')
+        Model = pool.get(model)
+
+        for template in templates:
+            records = Model.browse(record_ids)
+            if enqueued_at:
+                mails = ElectronicEmail.search([
+                        ('template', '=', template.id),
+                        ('resource', 'in', [str(r) for r in records]),
+                        ('create_date', '>=', enqueued_at),
+                        ])
+                done = {str(m.resource) for m in mails}
+                groups = []
+                for language, sub_records in cls._group_records_by_language(
+                        template, records).items():
+                    with Transaction().set_context(language=language):
+                        groups.extend(
+                            cls._coalesce_records(template, sub_records))
+                records = [r for group in groups
+                    if not any(str(r) in done for r in group)
+                    for r in group]
+            if records:
+                # The records are committed when the task runs
+                cls.render_and_send(template.id, records,
+                    parallel_reports=True)
 
     def get_attachments(self, records):
         record_ids = [r.id for r in records]
         attachments = []
         for report in self.reports:
-            report = Pool().get(report.report_name, type='report')
-            ext, data, filename, file_name = report.execute(record_ids, {})
+            ext, data, filename, file_name = self._execute_report(
+                report, records, {})
 
             if file_name:
                 filename = self.eval(file_name, record_ids)
             filename = ext and '%s.%s' % (filename, ext) or filename
-            content_type, _ = mimetypes.guess_type(filename)
-            maintype, subtype = (
-                content_type or 'application/octet-stream'
-                ).split('/', 1)
-
-            attachment = MIMEBase(maintype, subtype, policy=self._get_policy())
-            attachment.set_payload(data)
-            encoders.encode_base64(attachment)
-            attachment.add_header(
-                'Content-Disposition', 'attachment', filename=filename)
-            attachments.append(attachment)
+            attachments.append(self._get_attachment(filename, data))
         return attachments
 
 
+def _html_to_markdown_batch(values):
+    'Converts the HTML values in a migration worker process'
+    return Template._html_to_markdown_batch(values)
+
+
+def _init_report_worker(database_name):
+    'Initializes the pool of the database in a report worker process'
+    if database_name not in Pool.database_list():
+        with Transaction(new=True).start(database_name, 0, readonly=True):
+            Pool(database_name).init()
+
+
+def _render_record_reports(database_name, user, context, template_id,
+        record, language):
+    'Renders the reports of the record in a report worker process'
+    # The forked worker inherits the transactions of the parent process so a
+    # new one must be started instead of reusing them
+    with Transaction(new=True).start(
+            database_name, user, readonly=True, context=context):
+        pool = Pool()
+        Template = pool.get('electronic.mail.template')
+        model, record_id = record.split(',')
+        record = pool.get(model)(int(record_id))
+        template = Template(template_id)
+        return Template.render_reports_batch(
+            template, [record], language)[record.id]
+
+
 class TemplateReport(ModelSQL):
     'Template - Report Action'
     __name__ = 'electronic.mail.template.ir.action.report'
@@ -0,0 +1,270 @@
+# This file is part electronic_mail_template module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""Benchmark of the render and send throughput of e-mail templates
+
+It creates a SQLite test database, N users as records and one template per
+engine, with and without signature and reports, and measures the render,
+render_and_send and _send_mail stages against a local SMTP sink.
+
+The results are written as JSON:
+
+    python -m trytond.modules.electronic_mail_template.tests.benchmark \\
+        --records 500 --output benchmark.json
+"""
+import argparse
+import json
+import os
+import resource
+import socketserver
+import sys
+import threading
+import time
+
+os.environ.setdefault('TRYTOND_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('DB_NAME', ':memory:')
+
+from trytond.pool import Pool  # noqa: E402
+from trytond.tests.test_tryton import (  # noqa: E402
+    DB_NAME, USER, activate_module)
+from trytond.transaction import Transaction  # noqa: E402
+
+ENGINES = {
+    'python': {
+        'from_': "'bench@example.com'",
+        'to': 'record.email',
+        'subject': "'Hello ' + record.name",
+        'markdown': "'Dear **' + record.name + '**,\\n\\n"
+            "Your login is `' + record.login + '`.'",
+        'file_name': "'user-' + record.login",
+        },
+    'genshi': {
+        'from_': 'bench@example.com',
+        'to': '${record.email}',
+        'subject': 'Hello ${record.name}',
+        'markdown': 'Dear **${record.name}**,\n\n'
+            'Your login is `${record.login}`.',
+        'file_name': 'user-${record.login}',
+        },
+    'jinja2': {
+        'from_': 'bench@example.com',
+        'to': '{{ record.email }}',
+        'subject': 'Hello {{ record.name }}',
+        'markdown': 'Dear **{{ record.name }}**,\n\n'
+            'Your login is `{{ record.login }}`.',
+        'file_name': 'user-{{ record.login }}',
+        },
+    }
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    'Accepts and discards all the messages'
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.reply('220 localhost benchmark sink')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command = line[:4].upper()
+            if command == b'EHLO':
+                self.reply('250-localhost')
+                self.reply('250 8BITMIME')
+            elif command == b'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                for data in self.rfile:
+                    if data in {b'.\r\n', b'.\n'}:
+                        break
+                self.server.messages += 1
+                self.reply('250 OK')
+            elif command == b'QUIT':
+                self.reply('221 Bye')
+                break
+            else:
+                self.reply('250 OK')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPSinkHandler)
+        self.messages = 0
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def stage_result(timings):
+    total = sum(timings)
+    return {
+        'count': len(timings),
+        'total': total,
+        'per_second': len(timings) / total if total else None,
+        'p50': percentile(timings, 0.5),
+        'p99': percentile(timings, 0.99),
+        }
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def setup(records, smtp_port):
+    pool = Pool()
+    ActionReport = pool.get('ir.action.report')
+    Mailbox = pool.get('electronic.mail.mailbox')
+    Model = pool.get('ir.model')
+    SMTPServer = pool.get('smtp.server')
+    User = pool.get('res.user')
+
+    mailbox, draft_mailbox = Mailbox.create([
+            {'name': 'Benchmark'},
+            {'name': 'Benchmark Draft'},
+            ])
+    model, = Model.search([('name', '=', 'res.user')])
+    smtp_server, = SMTPServer.create([{
+                'name': 'Benchmark Sink',
+                'smtp_server': '127.0.0.1',
+                'smtp_port': smtp_port,
+                'smtp_ssl': False,
+                'smtp_tls': False,
+                'smtp_email': 'bench@example.com',
+                'default': True,
+                }])
+    SMTPServer.done([smtp_server])
+    report, = ActionReport.create([{
+                'name': 'Benchmark Report',
+                'model': 'res.user',
+                'report_name': 'res.user.electronic_mail_benchmark',
+                'report_content_custom': (
+                    b'User ${record.name} (${record.login})\n'),
+                'template_extension': 'txt',
+                'extension': 'txt',
+                }])
+    admin = User(Transaction().user)
+    admin.signature = '<p>Kind regards,<br/><strong>Benchmark</strong></p>'
+    admin.save()
+    users = User.create([{
+                'name': 'Benchmark User %s' % i,
+                'login': 'benchmark%s' % i,
+                'email': 'benchmark%s@example.com' % i,
+                } for i in range(records)])
+    return {
+        'model': model,
+        'mailbox': mailbox,
+        'draft_mailbox': draft_mailbox,
+        'smtp_server': smtp_server,
+        'report': report,
+        'records': users,
+        }
+
+
+def run_scenario(data, engine, signature, reports):
+    pool = Pool()
+    ActionReport = pool.get('ir.action.report')
+    Mail = pool.get('electronic.mail')
+    Template = pool.get('electronic.mail.template')
+
+    expressions = ENGINES[engine]
+    report = data['report']
+    ActionReport.write([report], {'file_name': expressions['file_name']})
+    template, = Template.create([{
+                'name': 'Benchmark %s' % engine,
+                'model': data['model'].id,
+                'mailbox': data['mailbox'].id,
+                'draft_mailbox': data['draft_mailbox'].id,
+                'smtp_server': data['smtp_server'].id,
+                'engine': engine,
+                'from_': expressions['from_'],
+                'to': expressions['to'],
+                'subject': expressions['subject'],
+                'markdown': expressions['markdown'],
+                'signature': signature,
+                'reports': [('add', [report.id])] if reports else [],
+                }])
+    values = Template._get_render_values(template)
+    records = data['records']
+
+    render = []
+    for record in records:
+        duration, _ = timed(Template.render, template, record, values)
+        render.append(duration)
+
+    render_and_send = []
+    for record in records:
+        duration, _ = timed(Template.render_and_send, template.id, [record])
+        render_and_send.append(duration)
+
+    mails = Mail.search([('template', '=', template.id)])
+    send = []
+    for mail in mails:
+        duration, _ = timed(Mail._send_mail, [mail])
+        send.append(duration)
+
+    return {
+        'engine': engine,
+        'signature': signature,
+        'reports': reports,
+        'records': len(records),
+        'mails_per_second': (
+            len(records) / sum(render_and_send) if records else None),
+        'stages': {
+            'render': stage_result(render),
+            'render_and_send': stage_result(render_and_send),
+            'send': stage_result(send),
+            },
+        }
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--records', type=int, default=100,
+        help='number of records to render for each scenario')
+    parser.add_argument('-e', '--engine', dest='engines', action='append',
+        choices=list(ENGINES), help='engines to benchmark (default: all)')
+    parser.add_argument('-o', '--output', help='file to write the JSON to')
+    options = parser.parse_args(arguments)
+
+    sink = SMTPSink()
+    threading.Thread(target=sink.serve_forever, daemon=True).start()
+    try:
+        activate_module('electronic_mail_template')
+        results = []
+        with Transaction().start(DB_NAME, USER, context={}) as transaction:
+            data = setup(options.records, sink.server_address[1])
+            for engine in options.engines or list(ENGINES):
+                for signature in (False, True):
+                    for reports in (False, True):
+                        results.append(
+                            run_scenario(data, engine, signature, reports))
+            transaction.rollback()
+    finally:
+        sink.shutdown()
+
+    output = {
+        'database': os.environ['TRYTOND_DATABASE_URI'],
+        'scenarios': results,
+        'smtp_messages': sink.messages,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        }
+    if options.output:
+        with open(options.output, 'w') as file:
+            json.dump(output, file, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
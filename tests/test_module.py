@@ -2,17 +2,116 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
+import datetime
+import email
+import io
+import smtplib
+import unittest
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
 from textwrap import dedent
 from unittest.mock import patch
 
 from sql import Column
 from trytond.modules.company.tests.test_module import create_company, set_company
 from trytond.modules.company.tests import CompanyTestMixin
+from trytond.modules.electronic_mail_template.tools import LRUCache
+from trytond import backend
 from trytond.pool import Pool
-from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.tests.test_tryton import (
+    DB_NAME, ModuleTestCase, with_transaction)
 from trytond.transaction import Transaction
 
 
+def create_template(**values):
+    'Creates a template of users with its mailboxes and SMTP server'
+    pool = Pool()
+    Mailbox = pool.get('electronic.mail.mailbox')
+    Model = pool.get('ir.model')
+    SMTPServer = pool.get('smtp.server')
+    Template = pool.get('electronic.mail.template')
+
+    mailbox, draft_mailbox = Mailbox.create([
+            {'name': 'Inbox'},
+            {'name': 'Draft'},
+            ])
+    model, = Model.search([
+            ('name', '=', 'res.user'),
+            ], limit=1)
+    smtp_server, = SMTPServer.create([{
+                'name': 'SMTP',
+                'smtp_server': 'smtp.example.com',
+                'smtp_email': 'support@example.com',
+                }])
+    SMTPServer.done([smtp_server])
+    template_values = {
+        'name': 'Template',
+        'model': model.id,
+        'mailbox': mailbox.id,
+        'draft_mailbox': draft_mailbox.id,
+        'smtp_server': smtp_server.id,
+        'engine': 'jinja2',
+        'from_': 'support@example.com',
+        'to': '{{ record.email }}',
+        'subject': 'Hello {{ record.login }}',
+        'markdown': 'Dear **{{ record.name }}**',
+        }
+    template_values.update(values)
+    template, = Template.create([template_values])
+    return template
+
+
+def create_users(count, email=None):
+    'Creates the users to render the templates for'
+    User = Pool().get('res.user')
+    return User.create([{
+                'name': 'User %s' % i,
+                'login': 'user%s' % i,
+                'email': email or 'user%s@example.com' % i,
+                } for i in range(count)])
+
+
+def create_default_smtp_server(company, **values):
+    'Creates the inbox, the draft mailbox and the default SMTP server'
+    pool = Pool()
+    ConfigurationCompany = pool.get('electronic.mail.configuration.company')
+    Mailbox = pool.get('electronic.mail.mailbox')
+    SMTPServer = pool.get('smtp.server')
+
+    inbox, draft = Mailbox.create([
+            {'name': 'Inbox'},
+            {'name': 'Draft'},
+            ])
+    ConfigurationCompany.create([{
+                'company': company.id,
+                'draft': draft.id,
+                }])
+    server_values = {
+        'name': 'SMTP',
+        'smtp_server': 'smtp.example.com',
+        'smtp_email': 'support@example.com',
+        'default': True,
+        }
+    server_values.update(values)
+    smtp_server, = SMTPServer.create([server_values])
+    SMTPServer.done([smtp_server])
+    return inbox, smtp_server
+
+
+def create_mails(mailbox, count, recipients=None):
+    'Creates mails ready to be sent'
+    Mail = Pool().get('electronic.mail')
+    if recipients is None:
+        recipients = ['customer%s@example.com' % i for i in range(count)]
+    return Mail.create([{
+                'mailbox': mailbox.id,
+                'from_': 'sender@example.com',
+                'to': recipients[i],
+                'subject': 'Mail %s' % i,
+                'mail_file': b'mail',
+                } for i in range(count)])
+
+
 class ElectronicMailTemplateTestCase(CompanyTestMixin, ModuleTestCase):
     'Test ElectronicMailTemplate module'
     module = 'electronic_mail_template'
@@ -73,6 +172,42 @@ class ElectronicMailTemplateTestCase(CompanyTestMixin, ModuleTestCase):
         self.assertIn('4. four', plain)
         self.assertIn('* three', plain)
 
+    @with_transaction()
+    def test_markdown_convert_reuses_converter(self):
+        Template = Pool().get('electronic.mail.template')
+
+        html, plain = Template._markdown_convert('* one\n* two')
+        self.assertIn('<ul>', html)
+        self.assertIn('* one', plain)
+
+        html, plain = Template._markdown_convert('Just **text**')
+        self.assertEqual(html, '<p>Just <strong>text</strong></p>')
+        self.assertNotIn('<ul>', html)
+        self.assertEqual(Template._markdown_to_plain('Just **text**'), plain)
+        self.assertEqual(Template._markdown_convert(''), ('', ''))
+
+    @with_transaction()
+    def test_write_message_streams_attachments(self):
+        Template = Pool().get('electronic.mail.template')
+        message = MIMEMultipart(policy=Template._get_policy())
+        message['Subject'] = 'Invoice'
+        message.attach(MIMEText('Body', 'plain', _charset='utf-8',
+                policy=Template._get_policy()))
+        data = bytes(range(256)) * 1000
+
+        file = io.BytesIO()
+        Template._write_message(
+            message, [('invoice.pdf', data), ('notes.txt', b'notes')], file)
+
+        parsed = email.message_from_bytes(file.getvalue())
+        self.assertFalse(parsed.defects)
+        body, invoice, notes = parsed.get_payload()
+        self.assertEqual(body.get_payload(decode=True), b'Body')
+        self.assertEqual(invoice.get_filename(), 'invoice.pdf')
+        self.assertEqual(invoice.get_content_type(), 'application/pdf')
+        self.assertEqual(invoice.get_payload(decode=True), data)
+        self.assertEqual(notes.get_payload(decode=True), b'notes')
+
     @with_transaction()
     def test_html_to_markdown_unescapes_template_expressions(self):
         Template = Pool().get('electronic.mail.template')
@@ -92,6 +227,19 @@ class ElectronicMailTemplateTestCase(CompanyTestMixin, ModuleTestCase):
         self.assertIn('${record.invoice_date}', markdown)
         self.assertNotIn(r'\_', markdown)
 
+    @with_transaction()
+    def test_html_to_markdown_batch(self):
+        Template = Pool().get('electronic.mail.template')
+        values = ['<p>One</p>', '', '<p>One</p>', '<h1>Two</h1>']
+
+        markdowns = Template._html_to_markdown_batch(values)
+
+        self.assertEqual(
+            markdowns, [Template._html_to_markdown(v) for v in values])
+        self.assertEqual(markdowns[0], 'One')
+        self.assertEqual(markdowns[1], '')
+        self.assertEqual(markdowns[3], '# Two')
+
     @with_transaction()
     def test_unescape_template_expressions_keeps_normal_markdown_escaping(self):
         Template = Pool().get('electronic.mail.template')
@@ -105,6 +253,379 @@ class ElectronicMailTemplateTestCase(CompanyTestMixin, ModuleTestCase):
         self.assertIn('{{ record.invoice_date }}', unescaped)
         self.assertNotIn(r'{{ record.invoice\_date }}', unescaped)
 
+    @with_transaction()
+    def test_compiled_template_cache(self):
+        pool = Pool()
+        Template = pool.get('electronic.mail.template')
+        User = pool.get('res.user')
+
+        user = User(Transaction().user)
+        expression = 'Hello {{ record.login }} (compiled cache)'
+        stats = Template.compiled_cache_stats()
+
+        for _ in range(3):
+            self.assertEqual(
+                Template._engine_jinja2(expression, user),
+                'Hello %s (compiled cache)' % user.login)
+
+        new_stats = Template.compiled_cache_stats()
+        self.assertEqual(new_stats['miss'] - stats['miss'], 1)
+        self.assertEqual(new_stats['hit'] - stats['hit'], 2)
+
+    def test_lru_cache_size_limit(self):
+        cache = LRUCache(10, sizeof=lambda report: len(report[1]))
+
+        cache.set('a', ('pdf', b'1234'))
+        cache.set('b', ('pdf', b'1234'))
+        self.assertEqual(cache.get('a'), ('pdf', b'1234'))
+        cache.set('c', ('pdf', b'1234'))
+        cache.set('d', ('pdf', b'12345678901'))
+
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(cache.get('a'), ('pdf', b'1234'))
+        self.assertEqual(cache.get('c'), ('pdf', b'1234'))
+        self.assertEqual(cache.size, 8)
+
+    @with_transaction()
+    def test_python_engine_reuses_parsed_expression(self):
+        pool = Pool()
+        Template = pool.get('electronic.mail.template')
+        User = pool.get('res.user')
+
+        user = User(Transaction().user)
+        expression = "record.login + '@example.com'"
+        stats = Template.compiled_cache_stats()
+
+        for _ in range(2):
+            self.assertEqual(
+                Template._engine_python(expression, user),
+                '%s@example.com' % user.login)
+
+        new_stats = Template.compiled_cache_stats()
+        self.assertEqual(new_stats['miss'] - stats['miss'], 1)
+        self.assertEqual(new_stats['hit'] - stats['hit'], 1)
+
+    @with_transaction()
+    def test_eval_fields_single_pass(self):
+        pool = Pool()
+        Template = pool.get('electronic.mail.template')
+        User = pool.get('res.user')
+
+        user = User(Transaction().user)
+        template = Template(engine='jinja2')
+        values = {
+            'message_id': None,
+            'from_': '{{ record.login }}@example.com',
+            'to': 'to@example.com\n',
+            'cc': '{{ record.login }}@example.org',
+            'bcc': '',
+            'subject': 'Hello {{ record.login }}',
+            'markdown': '{% if record %}Body{% endif %}',
+            }
+
+        result = template.eval_fields(values, user)
+
+        self.assertEqual(result, {
+                'message_id': '',
+                'from_': '%s@example.com' % user.login,
+                'to': 'to@example.com',
+                'cc': '%s@example.org' % user.login,
+                'subject': 'Hello %s' % user.login,
+                'markdown': 'Body',
+                })
+        for name, value in result.items():
+            self.assertEqual(template.eval(values[name], user), value)
+
+    @with_transaction()
+    def test_eval_fields_keeps_rendered_newlines(self):
+        pool = Pool()
+        Template = pool.get('electronic.mail.template')
+        User = pool.get('res.user')
+
+        user = User(Transaction().user)
+        template = Template(engine='jinja2')
+        values = {
+            'message_id': '{{ "<id>\\n" }}',
+            'from_': 'from@example.com\r\n',
+            'to': 'to@example.com',
+            'subject': 'Hello',
+            'markdown': '{% for i in [1, 2] %}{{ i }}\n{% endfor %}',
+            }
+
+        result = template.eval_fields(values, user)
+
+        self.assertEqual(result['message_id'], '<id>\n')
+        self.assertEqual(result['from_'], 'from@example.com')
+        self.assertEqual(result['markdown'], '1\n2\n')
+        for name, value in result.items():
+            self.assertEqual(template.eval(values[name], user), value)
+
+    @with_transaction()
+    def test_eval_fields_with_blocks(self):
+        pool = Pool()
+        Template = pool.get('electronic.mail.template')
+        User = pool.get('res.user')
+
+        user = User(Transaction().user)
+        template = Template(engine='jinja2')
+        values = {
+            'message_id': None,
+            'from_': 'from@example.com',
+            'to': 'to@example.com',
+            'subject': '{% block subject %}Hello{% endblock %}',
+            'markdown': '{%- block body %}Body{% endblock %}',
+            }
+
+        result = template.eval_fields(values, user)
+
+        self.assertEqual(result['subject'], 'Hello')
+        self.assertEqual(result['markdown'], 'Body')
+        self.assertEqual(result['to'], 'to@example.com')
+
+    @with_transaction()
+    def test_prefetch_paths(self):
+        Template = Pool().get('electronic.mail.template')
+        values = {f: None for f in [
+                'message_id', 'in_reply_to', 'references', 'from_', 'sender',
+                'to', 'cc', 'bcc', 'subject', 'markdown', 'language']}
+        values.update({
+                'to': '{{ record.party.addresses[0].email }}',
+                'subject': 'Invoice {{ record.number }}',
+                'markdown': 'Dear {{ record.party.name }}, '
+                '{{ record.party.addresses[0].street }}',
+                'reports': [],
+                'prefetch': None,
+                })
+
+        template = Template(**values)
+        self.assertEqual(template.get_prefetch_paths(), [
+                ('number',),
+                ('party', 'addresses', 'email'),
+                ('party', 'addresses', 'street'),
+                ('party', 'name'),
+                ])
+
+        template.prefetch = 'party.addresses\n\nlines.product\n'
+        self.assertEqual(template.get_prefetch_paths(), [
+                ('lines', 'product'),
+                ('party', 'addresses'),
+                ])
+
+    @with_transaction()
+    def test_render_and_send_batch(self):
+        pool = Pool()
+        Configuration = pool.get('electronic.mail.configuration')
+        Mail = pool.get('electronic.mail')
+        Template = pool.get('electronic.mail.template')
+
+        template = create_template()
+        users = create_users(3)
+        values = Template._get_render_values(template)
+
+        with patch.object(Mail, '__queue__') as queue:
+            Template._render_and_send_batch(
+                template, values, None, users, Configuration(1))
+
+        mails = Mail.search([('template', '=', template.id)],
+            order=[('id', 'ASC')])
+        self.assertEqual(len(mails), 3)
+        queue.send_mail.assert_called_once_with(mails)
+        for mail, user in zip(mails, users):
+            self.assertEqual(mail.mailbox, template.mailbox)
+            self.assertEqual(mail.resource, user)
+            self.assertEqual(mail.to, user.email)
+            self.assertEqual(mail.subject, 'Hello %s' % user.login)
+            self.assertIsNone(mail.date.tzinfo)
+            message = email.message_from_bytes(mail.mail_file)
+            self.assertEqual(message['Message-Id'], mail.message_id)
+
+    @with_transaction()
+    def test_render_and_send_batch_renders_reports_per_mail(self):
+        pool = Pool()
+        ActionReport = pool.get('ir.action.report')
+        Configuration = pool.get('electronic.mail.configuration')
+        Mail = pool.get('electronic.mail')
+        Template = pool.get('electronic.mail.template')
+
+        report, = ActionReport.create([{
+                    'name': 'User',
+                    'model': 'res.user',
+                    'report_name': 'res.user.electronic_mail_test',
+                    'report_content_custom': b'User ${record.login}',
+                    'template_extension': 'txt',
+                    'extension': 'txt',
+                    }])
+        template = create_template(reports=[('add', [report.id])])
+        users = create_users(3)
+        values = Template._get_render_values(template)
+
+        with patch.object(Mail, '__queue__') as queue, \
+                patch.object(Template, 'render_reports_batch',
+                    return_value={}) as render_reports_batch:
+            Template._render_and_send_batch(
+                template, values, None, users, Configuration(1))
+
+        self.assertEqual(
+            [c.args[1] for c in render_reports_batch.call_args_list],
+            [[u] for u in users])
+        self.assertEqual(len(queue.send_mail.call_args.args[0]), 3)
+
+    @with_transaction()
+    def test_render_reports_batch_parallel_only_when_requested(self):
+        Template = Pool().get('electronic.mail.template')
+
+        template = create_template()
+        users = create_users(2)
+
+        with patch('trytond.modules.electronic_mail_template.template.'
+                'REPORT_WORKERS', 2), \
+                patch.object(Template, '_render_reports_parallel',
+                    return_value={}) as render_reports_parallel:
+            self.assertEqual(
+                Template.render_reports_batch(template, users), {})
+            render_reports_parallel.assert_not_called()
+
+            Template.render_reports_batch(template, users, parallel=True)
+            render_reports_parallel.assert_called_once_with(
+                template, users, None)
+
+    @unittest.skipUnless(backend.name == 'sqlite' and DB_NAME == ':memory:',
+        'the workers only see the records of the test in a memory database')
+    @with_transaction()
+    def test_render_reports_parallel(self):
+        pool = Pool()
+        ActionReport = pool.get('ir.action.report')
+        Template = pool.get('electronic.mail.template')
+
+        report, = ActionReport.create([{
+                    'name': 'User',
+                    'model': 'res.user',
+                    'report_name': 'res.user.electronic_mail_test',
+                    'report_content_custom': b'User ${record.login}',
+                    'template_extension': 'txt',
+                    'extension': 'txt',
+                    }])
+        template = create_template(reports=[('add', [report.id])])
+        users = create_users(2)
+
+        with patch('trytond.modules.electronic_mail_template.template.'
+                'REPORT_WORKERS', 2):
+            reports = Template._render_reports_parallel(template, users)
+
+        for user in users:
+            (ext, data, _, _), = reports[user.id]
+            self.assertEqual(ext, 'txt')
+            self.assertIn(user.login, str(data))
+
+    @with_transaction()
+    def test_enqueue_render_and_send(self):
+        Template = Pool().get('electronic.mail.template')
+
+        template = create_template(deferred=True)
+        users = create_users(3)
+
+        with patch('trytond.modules.electronic_mail_template.template.'
+                'DEFERRED_BATCH_SIZE', 2), \
+                patch.object(Template, '__queue__') as queue:
+            Template.enqueue_render_and_send(template, users)
+
+        calls = queue.render_and_send_deferred.call_args_list
+        self.assertEqual(len(calls), 2)
+        for call, ids in zip(calls, [
+                    [users[0].id, users[1].id], [users[2].id]]):
+            templates, model, record_ids, enqueued_at = call.args
+            self.assertEqual(templates, [template])
+            self.assertEqual(model, 'res.user')
+            self.assertEqual(record_ids, ids)
+            self.assertIsInstance(enqueued_at, datetime.datetime)
+
+    @with_transaction()
+    def test_render_and_send_deferred_skips_rendered_records(self):
+        pool = Pool()
+        Mail = pool.get('electronic.mail')
+        Template = pool.get('electronic.mail.template')
+
+        template = create_template(
+            deferred=True, coalesce='{{ record.id % 2 }}')
+        users = create_users(3)
+        enqueued_at = datetime.datetime.now() - datetime.timedelta(minutes=1)
+
+        with patch.object(Mail, '__queue__'):
+            for _ in range(2):
+                Template.render_and_send_deferred([template], 'res.user',
+                    [u.id for u in users], enqueued_at)
+                mails = Mail.search([('template', '=', template.id)])
+                self.assertEqual(len(mails), 2)
+
+    @with_transaction()
+    def test_render_and_send_coalesces_records(self):
+        pool = Pool()
+        Mail = pool.get('electronic.mail')
+        Template = pool.get('electronic.mail.template')
+        User = pool.get('res.user')
+
+        template = create_template(coalesce='{{ record.email }}')
+        users = create_users(3)
+        User.write([users[2]], {'email': users[0].email})
+
+        with patch.object(Mail, '__queue__') as queue:
+            Template.render_and_send(template.id, users)
+
+        mails = Mail.search([('template', '=', template.id)],
+            order=[('id', 'ASC')])
+        self.assertEqual(len(mails), 2)
+        queue.send_mail.assert_called_once_with(mails)
+        self.assertEqual([m.resource for m in mails], users[:2])
+        self.assertEqual(
+            [m.to for m in mails], [users[0].email, users[1].email])
+
+    @with_transaction()
+    def test_render_and_send_reuses_rendered_mails(self):
+        pool = Pool()
+        Mail = pool.get('electronic.mail')
+        Template = pool.get('electronic.mail.template')
+        User = pool.get('res.user')
+
+        template = create_template(reuse_mails=True)
+        user, = create_users(1)
+        domain = [('template', '=', template.id)]
+
+        with patch.object(Mail, '__queue__') as queue:
+            Template.render_and_send(template.id, [User(user.id)])
+            mail, = Mail.search(domain)
+            self.assertTrue(mail.render_key)
+
+            # The unsent mail is enqueued again
+            queue.reset_mock()
+            with patch.object(Template, 'render') as render:
+                Template.render_and_send(template.id, [User(user.id)])
+                render.assert_not_called()
+            queue.send_mail.assert_called_once_with([mail])
+            self.assertEqual(Mail.search_count(domain), 1)
+
+            # The sent mail is copied to send it again
+            Mail.write([mail], {'flag_send': True})
+            queue.reset_mock()
+            with patch.object(Template, 'render') as render:
+                Template.render_and_send(template.id, [User(user.id)])
+                render.assert_not_called()
+            copy, = Mail.search(domain + [('id', '!=', mail.id)])
+            self.assertFalse(copy.flag_send)
+            self.assertEqual(copy.render_key, mail.render_key)
+            self.assertEqual(copy.mail_file, mail.mail_file)
+            queue.send_mail.assert_called_once_with([copy])
+
+            # The modified record is rendered again
+            User.write([User(user.id)], {'name': 'Modified'})
+            queue.reset_mock()
+            Template.render_and_send(template.id, [User(user.id)])
+            new_mail, = Mail.search(
+                domain + [('id', 'not in', [mail.id, copy.id])])
+            self.assertNotEqual(new_mail.render_key, mail.render_key)
+            self.assertIn(b'Modified', new_mail.mail_file)
+            queue.send_mail.assert_called_once_with([new_mail])
+
     @with_transaction()
     def test_register_migrates_translated_html_when_source_is_empty(self):
         pool = Pool()
@@ -290,5 +811,262 @@ class ElectronicMailTemplateTestCase(CompanyTestMixin, ModuleTestCase):
             self.assertFalse(invalid_sender.flag_send)
             self.assertFalse(blank_recipient.flag_send)
 
+    @with_transaction()
+    def test_send_mail_reuses_smtp_connection(self):
+        pool = Pool()
+        ConfigurationCompany = pool.get('electronic.mail.configuration.company')
+        Mail = pool.get('electronic.mail')
+        Mailbox = pool.get('electronic.mail.mailbox')
+        SMTPServer = pool.get('smtp.server')
+
+        company = create_company()
+        with set_company(company):
+            inbox, draft = Mailbox.create([
+                    {'name': 'Inbox'},
+                    {'name': 'Draft'},
+                    ])
+            ConfigurationCompany.create([{
+                        'company': company.id,
+                        'draft': draft.id,
+                        }])
+            smtp_server, = SMTPServer.create([{
+                        'name': 'SMTP',
+                        'smtp_server': 'smtp.example.com',
+                        'smtp_email': 'support@example.com',
+                        'default': True,
+                        'max_messages_per_connection': 2,
+                        }])
+            SMTPServer.done([smtp_server])
+
+            mails = Mail.create([{
+                        'mailbox': inbox.id,
+                        'from_': 'sender@example.com',
+                        'to': 'customer%s@example.com' % i,
+                        'subject': 'Mail %s' % i,
+                        'mail_file': b'mail',
+                        } for i in range(3)])
+
+            with patch.object(SMTPServer, 'get_smtp_server') as get_smtp_server:
+                connection = get_smtp_server.return_value
+                Mail._send_mail(mails)
+                self.assertEqual(get_smtp_server.call_count, 2)
+                self.assertEqual(connection.sendmail.call_count, 3)
+                self.assertEqual(connection.quit.call_count, 2)
+            for cache in Transaction().cache.values():
+                cache.clear()
+
+            for mail in Mail.browse([m.id for m in mails]):
+                self.assertTrue(mail.flag_send)
+
+    @with_transaction()
+    def test_send_mail_skips_sent_mails(self):
+        pool = Pool()
+        Mail = pool.get('electronic.mail')
+        SMTPServer = pool.get('smtp.server')
+
+        company = create_company()
+        with set_company(company):
+            inbox, _ = create_default_smtp_server(company)
+            mails = create_mails(inbox, 2)
+            # Sent by another task after being enqueued again
+            Mail.write([Mail(mails[0].id)], {'flag_send': True})
+
+            with patch.object(SMTPServer, 'get_smtp_server') as get_smtp_server:
+                connection = get_smtp_server.return_value
+                Mail._send_mail(mails)
+                self.assertEqual(connection.sendmail.call_count, 1)
+
+    @with_transaction()
+    def test_send_mail_delays_temporary_failures(self):
+        pool = Pool()
+        Mail = pool.get('electronic.mail')
+        SMTPServer = pool.get('smtp.server')
+
+        company = create_company()
+        with set_company(company):
+            inbox, _ = create_default_smtp_server(company)
+            mails = create_mails(inbox, 3)
+
+            with patch.object(SMTPServer, 'get_smtp_server') as get_smtp_server, \
+                    patch.object(Mail, '__queue__') as queue:
+                connection = get_smtp_server.return_value
+                connection.sendmail.side_effect = [
+                    None,
+                    smtplib.SMTPResponseException(451, b'Try again later'),
+                    None,
+                    ]
+                Mail._send_mail(mails)
+                self.assertEqual(connection.rset.call_count, 1)
+                queue._send_mail.assert_called_once_with([mails[1]])
+            for cache in Transaction().cache.values():
+                cache.clear()
+
+            self.assertEqual(
+                [m.flag_send for m in Mail.browse([m.id for m in mails])],
+                [True, False, True])
+
+    @with_transaction()
+    def test_send_mail_flags_mails_sent_before_failure(self):
+        pool = Pool()
+        Mail = pool.get('electronic.mail')
+        SMTPServer = pool.get('smtp.server')
+
+        company = create_company()
+        with set_company(company):
+            inbox, _ = create_default_smtp_server(company)
+            mails = create_mails(inbox, 3)
+
+            with patch.object(SMTPServer, 'get_smtp_server') as get_smtp_server, \
+                    patch.object(Mail, '__queue__') as queue:
+                connection = get_smtp_server.return_value
+                connection.sendmail.side_effect = [
+                    None,
+                    smtplib.SMTPResponseException(550, b'No such user'),
+                    None,
+                    ]
+                Mail._send_mail(mails)
+                self.assertEqual(connection.sendmail.call_count, 3)
+                queue._send_mail.assert_not_called()
+            for cache in Transaction().cache.values():
+                cache.clear()
+
+            self.assertEqual(
+                [m.flag_send for m in Mail.browse([m.id for m in mails])],
+                [True, False, True])
+
+    @with_transaction()
+    def test_send_mail_delivers_in_parallel(self):
+        pool = Pool()
+        Mail = pool.get('electronic.mail')
+
+        def deliver(database_name, user, context, server_id, deliveries):
+            return [(mail_id, mail_id != mails[2].id)
+                for mail_id, _, _, _ in deliveries]
+
+        company = create_company()
+        with set_company(company):
+            inbox, smtp_server = create_default_smtp_server(
+                company, delivery_workers=2)
+            mails = create_mails(inbox, 3)
+
+            with patch('trytond.modules.electronic_mail_template.'
+                    'electronic_mail.deliver', side_effect=deliver) as mock, \
+                    patch.object(Mail, '__queue__') as queue:
+                Mail._send_mail(mails)
+                self.assertEqual(mock.call_count, 2)
+                delivered = sorted(d[0] for call in mock.call_args_list
+                    for d in call.args[4])
+                self.assertEqual(delivered, sorted(m.id for m in mails))
+                for call in mock.call_args_list:
+                    self.assertEqual(call.args[3], smtp_server.id)
+                queue._send_mail.assert_called_once_with([mails[2]])
+            for cache in Transaction().cache.values():
+                cache.clear()
+
+            self.assertEqual(
+                [m.flag_send for m in Mail.browse([m.id for m in mails])],
+                [True, True, False])
+
+    @with_transaction()
+    def test_send_mail_keeps_results_of_other_workers(self):
+        pool = Pool()
+        Mail = pool.get('electronic.mail')
+
+        def deliver(database_name, user, context, server_id, deliveries):
+            if any(d[0] == mails[1].id for d in deliveries):
+                raise RuntimeError('Worker failure')
+            return [(mail_id, True) for mail_id, _, _, _ in deliveries]
+
+        company = create_company()
+        with set_company(company):
+            inbox, _ = create_default_smtp_server(company, delivery_workers=2)
+            mails = create_mails(inbox, 3)
+
+            with patch('trytond.modules.electronic_mail_template.'
+                    'electronic_mail.deliver', side_effect=deliver), \
+                    patch.object(Mail, '__queue__') as queue:
+                Mail._send_mail(mails)
+                queue._send_mail.assert_not_called()
+            for cache in Transaction().cache.values():
+                cache.clear()
+
+            self.assertEqual(
+                [m.flag_send for m in Mail.browse([m.id for m in mails])],
+                [True, False, True])
+
+    @with_transaction()
+    def test_send_mail_enqueues_batches(self):
+        pool = Pool()
+        Mail = pool.get('electronic.mail')
+        module = 'trytond.modules.electronic_mail_template.electronic_mail.'
+
+        company = create_company()
+        with set_company(company):
+            inbox, _ = create_default_smtp_server(company)
+            mails = create_mails(inbox, 5)
+            Mail.write(mails[:1], {'flag_send': True})
+
+            with patch(module + 'PRODUCTION_ENV', True), \
+                    patch(module + 'SEND_BATCH_SIZE', 2), \
+                    patch.object(Mail, '__queue__') as queue:
+                Mail.send_mail(mails)
+                self.assertEqual(
+                    [c.args[0] for c in queue._send_mail.call_args_list],
+                    [mails[1:3], mails[3:5]])
+
+    @with_transaction()
+    def test_send_mail_server_rate_limit(self):
+        pool = Pool()
+        Mail = pool.get('electronic.mail')
+        SMTPServer = pool.get('smtp.server')
+
+        company = create_company()
+        with set_company(company):
+            inbox, _ = create_default_smtp_server(company, rate_limit=2)
+            sent = create_mails(inbox, 1)
+            Mail.write(sent, {'flag_send': True})
+            mails = create_mails(inbox, 3)
+
+            with patch.object(SMTPServer, 'get_smtp_server') as get_smtp_server, \
+                    patch.object(Mail, '__queue__') as queue:
+                connection = get_smtp_server.return_value
+                Mail._send_mail(mails)
+                self.assertEqual(connection.sendmail.call_count, 1)
+                queue._send_mail.assert_called_once_with(mails[1:])
+
+    @with_transaction()
+    def test_send_mail_recipient_rate_limit(self):
+        pool = Pool()
+        Mail = pool.get('electronic.mail')
+        SMTPServer = pool.get('smtp.server')
+        module = 'trytond.modules.electronic_mail_template.electronic_mail.'
+
+        company = create_company()
+        with set_company(company):
+            inbox, _ = create_default_smtp_server(company)
+            sent = create_mails(inbox, 2,
+                ['Data <data@example.com>', 'b1c@example.com'])
+            Mail.write(sent, {'flag_send': True})
+            mails = create_mails(inbox, 4, [
+                    'a@example.com',
+                    'A@example.com',
+                    'data@example.com',
+                    'b_c@example.com',
+                    ])
+
+            with patch(module + 'RECIPIENT_RATE_LIMIT', 1), \
+                    patch.object(SMTPServer, 'get_smtp_server') as get_smtp_server, \
+                    patch.object(Mail, '__queue__') as queue:
+                connection = get_smtp_server.return_value
+                Mail._send_mail(mails)
+                self.assertEqual(connection.sendmail.call_count, 2)
+                queue._send_mail.assert_called_once_with(mails[1:3])
+            for cache in Transaction().cache.values():
+                cache.clear()
+
+            self.assertEqual(
+                [m.flag_send for m in Mail.browse([m.id for m in mails])],
+                [True, False, False, True])
+
 
 del ModuleTestCase
@@ -1,4 +1,6 @@
+import threading
 import unicodedata
+from collections import OrderedDict
 from email.utils import getaddresses
 
 def recipients_from_fields(email_record):
@@ -7,12 +9,68 @@ def recipients_from_fields(email_record):
 
     :param email_record: Browse record of the email
     """
-    recipients = []
-    for field in ('to', 'cc', 'bcc'):
-        mails = getattr(email_record, field)
-        if mails:
-            recipients.extend([a for _, a in getaddresses([mails])])
-    return recipients
+    values = [getattr(email_record, field) for field in ('to', 'cc', 'bcc')]
+    return [a for _, a in getaddresses([v for v in values if v])]
+
+class TemplateContext(dict):
+    'Template context that memoizes the callables for the python engine'
+
+    @property
+    def functions(self):
+        if not hasattr(self, '_functions'):
+            self._functions = {k: v for k, v in self.items() if callable(v)}
+        return self._functions
+
+
+class LRUCache(object):
+    '''Thread-safe LRU cache of the current process
+
+    The values are stored as they are, neither copied nor serialized, so it
+    can hold compiled templates.
+
+    :param size_limit: Maximum total size of the values
+    :param sizeof: Function that returns the size of a value. By default each
+        value counts as one so the limit is the number of entries.
+    '''
+
+    def __init__(self, size_limit, sizeof=None):
+        self.size_limit = size_limit
+        self.sizeof = sizeof or (lambda value: 1)
+        self.hit = self.miss = 0
+        self.size = 0
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._values[key]
+            except KeyError:
+                self.miss += 1
+                return default
+            self._values.move_to_end(key)
+            self.hit += 1
+            return value[0]
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        if size > self.size_limit:
+            return value
+        with self._lock:
+            if key in self._values:
+                self.size -= self._values.pop(key)[1]
+            self._values[key] = (value, size)
+            self.size += size
+            while self.size > self.size_limit:
+                _, (_, old_size) = self._values.popitem(last=False)
+                self.size -= old_size
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self.size = 0
+
 
 def unaccent(text):
     if isinstance(text, bytes):
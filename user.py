@@ -0,0 +1,14 @@
+# This file is part electronic_mail_template module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+
+class User(metaclass=PoolMeta):
+    __name__ = 'res.user'
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        Template = Pool().get('electronic.mail.template')
+        Template._signature_cache.clear()